@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+__all__ = ["PLANES", "GEO", "generate_population", "split_new", "mutate", "write_feed"]
+
+# Planes de DEMI_PLAN_LIST (nombre en el feed -> financiadora_plan.id)
+PLANES = {
+    "AZUL PLUS-VOL-ROS": "b60f55eb-c083-416e-a7fa-70657ba4ab81",
+    "DEMI OP - OBLIG- SM": "a9064b7f-d422-4eac-9eec-e8946f7990aa",
+    "VITALICIO": "e0c71154-a805-49e2-bc8b-253be83cf179",
+    "PLAN BASICO": "5f322351-b6a9-4976-902a-a05f75779944",
+    "DS 1000": "a1896f07-e202-4c89-be5e-24de5b174014",
+}
+
+# (provincia en el feed, localidad en el feed, loc_estado.nombre, loc_localidad.nombre)
+GEO = [
+    ("Santa Fe", "ROSARIO", "Santa Fe", "Rosario"),
+    ("Santa Fe", "SAN LORENZO", "Santa Fe", "San Lorenzo"),
+    ("Santa Fe", "CAP. BERMUDEZ", "Santa Fe", "Capitán Bermúdez"),
+    ("Cordoba", "CORDOBA", "Córdoba", "Córdoba"),
+    ("Entre Rios", "PARANA", "Entre Ríos", "Paraná"),
+]
+
+APELLIDOS = np.array(["GONZALEZ", "RODRIGUEZ", "GOMEZ", "FERNANDEZ", "LOPEZ", "DIAZ", "MARTINEZ", "PEREZ", "GARCIA", "SANCHEZ"])
+NOMBRES = np.array(["JUAN", "MARIA", "CARLOS", "ANA", "JOSE", "LUCIA", "PABLO", "SOFIA", "JORGE", "LAURA"])
+CALLES = np.array(["SAN MARTIN", "BELGRANO", "SARMIENTO", "CORRIENTES", "MITRE", "RIVADAVIA", "URQUIZA", "PELLEGRINI"])
+
+FEED_COLUMNS = [
+    "NUMEROTARJETA", "ID_AFILIADO", "ID_TITULAR", "ID_TIPOPARENTESCO", "TIPO_PARENTESCO", "APELLIDO_NOMBRE",
+    "FECHA_NACIMIENTO", "SEXO", "TIPO_DOCUMENTO", "NUMERODOCUMENTO", "EMAIL", "TELEFONO", "NOMBRE_PLAN",
+    "ESTADO_AFILIACION", "TIPO_CONDICION", "MOROSO", "CBU", "PROVINCIA", "LOCALIDAD", "CODIGO_POSTAL",
+    "CALLE", "NUMERO", "PISO", "DEPARTAMENTO",
+]
+
+
+def generate_population(rows: int, seed: int = 0, max_dependents: int = 3) -> pd.DataFrame:
+    """
+    Synthetic DEMI feed of `rows` afiliados grouped in families: a titular
+    followed by 0..max_dependents dependents sharing plan and address.
+    """
+    rng = np.random.default_rng(seed)
+    # tamaño de cada familia hasta cubrir rows
+    tamanos = rng.integers(1, max_dependents + 2, size=rows)
+    familia = np.repeat(np.arange(rows), tamanos)[:rows]
+    es_titular = np.r_[True, familia[1:] != familia[:-1]]
+    titular = np.maximum.accumulate(np.where(es_titular, np.arange(rows), 0))
+
+    id_afiliado = 1_000_000 + np.arange(rows)
+    geo = rng.integers(0, len(GEO), size=rows)[titular]
+    planes = np.array(list(PLANES))[rng.integers(0, len(PLANES), size=rows)][titular]
+    nacimiento = pd.Timestamp("1940-01-01") + pd.to_timedelta(rng.integers(0, 30000, size=rows), unit="D")
+    telefono = np.char.add("341", rng.integers(4_000_000, 6_999_999, size=rows).astype(str))
+
+    return pd.DataFrame({
+        "NUMEROTARJETA": 500_000 + np.arange(rows),
+        "ID_AFILIADO": id_afiliado,
+        "ID_TITULAR": pd.Series(id_afiliado[titular]).where(~es_titular).astype("Int64"),
+        "ID_TIPOPARENTESCO": np.where(es_titular, 1, 2),
+        "TIPO_PARENTESCO": np.where(es_titular, "TITULAR", "HIJO"),
+        "APELLIDO_NOMBRE": np.char.add(
+            np.char.add(APELLIDOS[rng.integers(0, len(APELLIDOS), size=rows)][titular], " "),
+            NOMBRES[rng.integers(0, len(NOMBRES), size=rows)],
+        ),
+        "FECHA_NACIMIENTO": nacimiento.strftime("%d-%m-%Y"),
+        "SEXO": rng.choice(["M", "F"], size=rows),
+        "TIPO_DOCUMENTO": "DNI",
+        "NUMERODOCUMENTO": 20_000_000 + np.arange(rows),
+        "EMAIL": "",
+        "TELEFONO": np.where(rng.random(rows) < 0.2, "NULL", telefono),
+        "NOMBRE_PLAN": planes,
+        "ESTADO_AFILIACION": "ACTIVO",
+        "TIPO_CONDICION": "",
+        "MOROSO": np.where(rng.random(rows) < 0.05, "SI", "NO"),
+        "CBU": "",
+        "PROVINCIA": [GEO[g][0] for g in geo],
+        "LOCALIDAD": [GEO[g][1] for g in geo],
+        "CODIGO_POSTAL": 2000 + geo,
+        "CALLE": CALLES[rng.integers(0, len(CALLES), size=rows)][titular],
+        "NUMERO": rng.integers(1, 9999, size=rows)[titular],
+        "PISO": "",
+        "DEPARTAMENTO": "",
+    })[FEED_COLUMNS]
+
+
+def split_new(df: pd.DataFrame, new: float) -> pd.DataFrame:
+    """
+    The afiliados already in core before the run: df without its last
+    `new` fraction, cut at a family boundary so whole families are new.
+    """
+    desde = int(len(df) * (1 - new))
+    titulares = np.flatnonzero(df["ID_TITULAR"].isna().to_numpy())
+    corte = titulares[np.searchsorted(titulares, desde)] if desde < titulares[-1] else len(df)
+    return df.iloc[:corte]
+
+
+def mutate(df: pd.DataFrame, modified: float, seed: int = 1) -> pd.DataFrame:
+    """
+    Copy of df where a `modified` fraction of the afiliados changed one of:
+    apellido, domicilio, telefono, plan or morosidad.
+    """
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    elegidos = np.flatnonzero(rng.random(len(df)) < modified)
+    tipo = rng.integers(0, 5, size=len(elegidos))
+
+    apellido = elegidos[tipo == 0]
+    df.loc[df.index[apellido], "APELLIDO_NOMBRE"] = "CAMBIADO " + df["APELLIDO_NOMBRE"].iloc[apellido]
+    domicilio = elegidos[tipo == 1]
+    df.loc[df.index[domicilio], "NUMERO"] = df["NUMERO"].iloc[domicilio] + 1
+    telefono = elegidos[tipo == 2]
+    df.loc[df.index[telefono], "TELEFONO"] = "3415550000"
+    plan = elegidos[tipo == 3]
+    nombres = np.array(list(PLANES))
+    actual = np.searchsorted(np.sort(nombres), df["NOMBRE_PLAN"].iloc[plan].to_numpy())
+    df.loc[df.index[plan], "NOMBRE_PLAN"] = np.sort(nombres)[(actual + 1) % len(nombres)]
+    moroso = elegidos[tipo == 4]
+    df.loc[df.index[moroso], "MOROSO"] = np.where(df["MOROSO"].iloc[moroso] == "NO", "SI", "NO")
+    return df
+
+
+def write_feed(df: pd.DataFrame, path: str):
+    """Writes df the way the DEMI FTP serves it: pipe separated, latin-1."""
+    df.to_csv(path, sep="|", index=False, encoding="latin-1")
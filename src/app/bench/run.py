@@ -0,0 +1,174 @@
+"""
+Benchmark of a full sync against a throwaway PostgreSQL.
+
+    cd src
+    python -m app.bench.run --rows 10000 100000 1000000 --out bench.json
+    python -m app.bench.run --rows 100000 --bulk --bulk-update --compare bench.json
+
+Uses the DB_* settings of the environment, but only ever writes inside the
+demi_bench schema, which is dropped and recreated for every size.
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from app.bench.generator import generate_population, mutate, split_new, write_feed
+from app.bench.schema import bench_connect, bench_pool, bootstrap
+from app.core.settings import settings
+from app.script.demi import ScriptDemi
+from app.script.feed_parser import PARSERS
+from app.script.gazetteer import Gazetteer
+from app.script.metrics import Metrics
+from app.script.schemas import FEED_DTYPES, peak_memory_mb
+
+def run_size(rows: int, args: argparse.Namespace) -> dict:
+    """Generates the feeds, bootstraps and seeds core, and times one sync of `rows` afiliados."""
+    logging.basicConfig(level=logging.INFO)
+    workdir = tempfile.mkdtemp(prefix=f"demi-bench-{rows}-")
+    poblacion = generate_population(rows, seed=args.seed)
+    base = split_new(poblacion, args.new)
+    write_feed(base, os.path.join(workdir, "base.txt"))
+    write_feed(mutate(poblacion, args.modified, seed=args.seed + 1), os.path.join(workdir, "DEMISALUD-Afiliados.txt"))
+    del poblacion
+
+    connection = bench_connect()
+    bootstrap(connection)
+    gazetteer = Gazetteer(connection, os.path.join(workdir, "gazetteer.pkl"))
+
+    # core arranca con el feed del dia anterior; la carga inicial no se mide
+    print(f"Seeding core with {len(base)} afiliados...")
+    inicio = time.perf_counter()
+    seed = ScriptDemi(connection, bulk=True, batch_size=args.batch_size, gazetteer=gazetteer, plan_state=args.plan_state)
+    seed.compare_data(
+        seed.load_old_data(),
+        pd.read_csv(os.path.join(workdir, "base.txt"), encoding="latin-1", sep="|", usecols=list(FEED_DTYPES), dtype=FEED_DTYPES),
+    )
+    seed_seconds = time.perf_counter() - inicio
+    connection.cursor().execute("ANALYZE")
+    connection.commit()
+
+    pool = bench_pool(args.workers) if args.workers > 1 else None
+    metrics = Metrics()
+    script = ScriptDemi(
+        connection,
+        ftp=False,
+        bulk=args.bulk,
+        bulk_update=args.bulk_update,
+        batch_size=args.batch_size,
+        stream=args.stream,
+        gazetteer=gazetteer,
+        pool=pool,
+        workers=args.workers,
+        metrics=metrics,
+        plan_state=args.plan_state,
+        snapshot_copy=args.snapshot_copy,
+        feed_parser=args.feed_parser,
+    )
+
+    # load_new_data / iter_new_data leen DEMISALUD-Afiliados.txt del directorio actual
+    os.chdir(workdir)
+    print(f"Timing sync of {rows} afiliados...")
+    inicio = time.perf_counter()
+    if script.stream:
+        script.sync_streaming(script.load_old_data())
+    else:
+        script.compare_data(*script.load_data())
+    total_seconds = time.perf_counter() - inicio
+
+    if pool is not None:
+        pool.closeall()
+    connection.close()
+    resumen = metrics.summary()
+    return {
+        "rows": rows,
+        "core_rows": len(base),
+        "seed_seconds": round(seed_seconds, 3),
+        "total_seconds": round(total_seconds, 3),
+        "peak_memory_mb": round(peak_memory_mb(), 1),
+        "stages": {nombre: {**stage, "seconds": round(stage["seconds"], 3)} for nombre, stage in resumen["stages"].items()},
+        "tables": resumen["tables"],
+    }
+
+
+def git_version() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, previous_path: str):
+    """Prints stage times of this run next to a previous results file."""
+    with open(previous_path) as previous_file:
+        previous = {run["rows"]: run for run in json.load(previous_file)["runs"]}
+    for run in results["runs"]:
+        anterior = previous.get(run["rows"])
+        if anterior is None:
+            continue
+        print(f"\n{run['rows']} rows (previous: {anterior.get('version', '?')})")
+        for nombre in list(run["stages"]) + ["total"]:
+            nuevo = run["total_seconds"] if nombre == "total" else run["stages"][nombre]["seconds"]
+            viejo = anterior["total_seconds"] if nombre == "total" else anterior["stages"].get(nombre, {}).get("seconds")
+            if viejo:
+                print(f"  {nombre:<26} {viejo:>10.2f}s -> {nuevo:>10.2f}s  x{nuevo / viejo:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a DEMI sync on synthetic data.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--modified", type=float, default=0.05, help="fraction of afiliados that changed")
+    parser.add_argument("--new", type=float, default=0.02, help="fraction of afiliados not in core yet")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bulk", action="store_true")
+    parser.add_argument("--bulk-update", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--plan-state", action="store_true", help="maintain and read afiliado_plan_actual")
+    parser.add_argument("--snapshot-copy", action="store_true", help="read the core snapshot through COPY TO STDOUT")
+    parser.add_argument("--feed-parser", choices=PARSERS, default="pandas", help="load_new_data parser backend")
+    parser.add_argument("--out", default="bench-results.json")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    parser.add_argument("--allow-remote", action="store_true", help="run against a non-local DB_HOST")
+    args = parser.parse_args()
+
+    if settings.DB_HOST not in ("localhost", "127.0.0.1", "::1") and not args.allow_remote:
+        parser.error(f"DB_HOST is {settings.DB_HOST}; the benchmark is meant for a throwaway local database")
+
+    results = {
+        "version": git_version(),
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "config": {k: v for k, v in vars(args).items() if k not in ("rows", "out", "compare", "allow_remote")},
+        "runs": [],
+    }
+    for rows in args.rows:
+        # cada tamaño en un proceso nuevo, asi el pico de memoria es solo de esa corrida
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            run = executor.submit(run_size, rows, args).result()
+        run["version"] = results["version"]
+        results["runs"].append(run)
+        print(f"{rows} rows: {run['total_seconds']}s, peak {run['peak_memory_mb']} MB")
+
+    with open(args.out, "w") as out:
+        json.dump(results, out, indent=2)
+    print(f"Results written to {args.out}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
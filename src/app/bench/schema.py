@@ -0,0 +1,153 @@
+import logging
+
+import psycopg2
+import psycopg2.pool
+
+from app.bench.generator import GEO, PLANES
+from app.core.database import CREDS
+from app.script import plan_state
+
+__all__ = ["BENCH_SCHEMA", "bench_connect", "bench_pool", "bootstrap"]
+
+# Todo el benchmark vive en su propio schema, nunca toca las tablas de public
+BENCH_SCHEMA = "demi_bench"
+
+DDL = """
+CREATE TABLE auth_role_entity (
+    id uuid PRIMARY KEY,
+    type text NOT NULL
+);
+CREATE TABLE loc_estado (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    nombre text NOT NULL
+);
+CREATE TABLE loc_localidad (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    nombre text NOT NULL,
+    id_loc_estado uuid REFERENCES loc_estado (id),
+    id_financiadora uuid
+);
+CREATE TABLE param_documento_identificatorio (
+    id integer PRIMARY KEY,
+    tipo text NOT NULL
+);
+CREATE TABLE persona (
+    id uuid PRIMARY KEY DEFAULT gen_random_uuid(),
+    nombre text,
+    apellido text,
+    fecha_nacimiento date,
+    genero_biologico text
+);
+CREATE TABLE persona_documento (
+    id uuid PRIMARY KEY,
+    id_persona uuid NOT NULL REFERENCES persona (id),
+    id_param_documento_identificatorio integer REFERENCES param_documento_identificatorio (id),
+    valor text
+);
+CREATE TABLE domicilio (
+    id uuid PRIMARY KEY,
+    codigo_postal text,
+    calle text,
+    numeracion text,
+    piso text,
+    departamento text,
+    descripcion text,
+    id_loc_localidad uuid REFERENCES loc_localidad (id)
+);
+CREATE TABLE persona_domicilio (
+    id_persona uuid NOT NULL REFERENCES persona (id),
+    id_domicilio uuid NOT NULL REFERENCES domicilio (id),
+    es_principal boolean
+);
+CREATE TABLE contacto (
+    id uuid PRIMARY KEY,
+    valor text,
+    tipo text[]
+);
+CREATE TABLE persona_contacto (
+    id_persona uuid NOT NULL REFERENCES persona (id),
+    id_contacto uuid NOT NULL REFERENCES contacto (id)
+);
+CREATE TABLE afiliado_parentezco_tipo (
+    id uuid PRIMARY KEY,
+    tipo text
+);
+CREATE TABLE afiliado (
+    id uuid PRIMARY KEY REFERENCES auth_role_entity (id),
+    id_persona uuid REFERENCES persona (id),
+    id_afiliado_titular uuid REFERENCES afiliado (id),
+    id_afiliado_parentezco_tipo uuid REFERENCES afiliado_parentezco_tipo (id),
+    codigo text,
+    id_financiadora uuid,
+    otp_secret text
+);
+CREATE TABLE financiadora_plan (
+    id uuid PRIMARY KEY,
+    nombre text
+);
+CREATE TABLE afiliado_plan (
+    id uuid PRIMARY KEY,
+    id_afiliado uuid NOT NULL REFERENCES afiliado (id),
+    id_financiadora_plan uuid REFERENCES financiadora_plan (id),
+    created_at timestamptz NOT NULL DEFAULT clock_timestamp()
+);
+CREATE TABLE afiliado_plan_estado (
+    id uuid PRIMARY KEY,
+    id_afiliado_plan uuid NOT NULL REFERENCES afiliado_plan (id),
+    estado text,
+    fecha_desde date
+);
+CREATE INDEX ON afiliado (id_financiadora);
+CREATE INDEX ON afiliado (codigo);
+CREATE INDEX ON persona_documento (id_persona);
+CREATE INDEX ON persona_domicilio (id_persona);
+CREATE INDEX ON persona_contacto (id_persona);
+CREATE INDEX ON afiliado_plan (id_afiliado);
+CREATE INDEX ON afiliado_plan_estado (id_afiliado_plan);
+"""
+
+
+def bench_connect() -> psycopg2.extensions.connection:
+    """Connection to the configured database with the bench schema first in the search_path."""
+    return psycopg2.connect(**CREDS, options=f"-c search_path={BENCH_SCHEMA}")
+
+
+def bench_pool(maxconn: int) -> psycopg2.pool.ThreadedConnectionPool:
+    return psycopg2.pool.ThreadedConnectionPool(1, maxconn, **CREDS, options=f"-c search_path={BENCH_SCHEMA}")
+
+
+def bootstrap(connection: psycopg2.extensions.connection):
+    """
+    Drops and recreates the bench schema with the core tables the script
+    reads and writes, plus the reference rows it expects (plans, document
+    types, states and cities).
+    """
+    logging.info(f"Bootstrapping schema {BENCH_SCHEMA}...")
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+        cursor.execute(f"SET LOCAL search_path TO {BENCH_SCHEMA}, public")
+        cursor.execute(DDL)
+        cursor.execute(plan_state.DDL)
+        cursor.executemany(
+            "INSERT INTO financiadora_plan (id, nombre) VALUES (%s, %s)",
+            [(id_plan, nombre) for nombre, id_plan in PLANES.items()],
+        )
+        cursor.executemany(
+            "INSERT INTO param_documento_identificatorio (id, tipo) VALUES (%s, %s)",
+            [(1, "DNI"), (7, "LE"), (8, "LC")],
+        )
+        for estado in sorted({geo[2] for geo in GEO}):
+            cursor.execute("INSERT INTO loc_estado (nombre) VALUES (%s) RETURNING id", (estado,))
+            id_estado = cursor.fetchone()[0]
+            cursor.executemany(
+                "INSERT INTO loc_localidad (nombre, id_loc_estado) VALUES (%s, %s)",
+                [(geo[3], id_estado) for geo in GEO if geo[2] == estado],
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
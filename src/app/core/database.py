@@ -1,8 +1,9 @@
 import psycopg2
+import psycopg2.pool
 import logging
 from app.core.settings.base import settings
 
-__all__ = ["connect"]
+__all__ = ["connect", "create_pool"]
 
 CREDS = {
     "host": settings.DB_HOST,
@@ -21,3 +22,11 @@ def connect() -> psycopg2.extensions.connection:
     conn = psycopg2.connect(**CREDS)
     logging.info(f'Connection to {CREDS.get("database")} database successful!')
     return conn
+
+
+def create_pool(maxconn: int) -> psycopg2.pool.ThreadedConnectionPool:
+    """
+    Bounded, thread-safe pool of connections to the PostgreSQL database server.
+    """
+    logging.info(f'Opening a pool of up to {maxconn} connections to {CREDS.get("database")}...')
+    return psycopg2.pool.ThreadedConnectionPool(1, maxconn, **CREDS)
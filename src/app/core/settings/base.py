@@ -12,6 +12,34 @@ class Settings(BaseSettings):
     FTP_USER: str | None
     FTP_PASSW: str | None
     BASE_FTP: str | None
+    BULK_INSERT: bool = False
+    BULK_UPDATE: bool = False
+    BATCH_SIZE: int = 5000
+    STREAM: bool = False
+    STREAM_MEMORY_MB: int = 512
+    STATE_DIR: str = ".demi_state"
+    INCREMENTAL: bool = False
+    FULL_RECONCILE: bool = False
+    WRITER_WORKERS: int = 1
+    BATCH_COMMIT: bool = False
+    METRICS: bool = False
+    METRICS_JSON: str = ".demi_state/metrics.json"
+    METRICS_TEXTFILE: str = ".demi_state/demi.prom"
+    PROGRESS_INTERVAL: float = 10.0
+    PROGRESS_SAMPLE: int = 1000
+    PROFILES: str = "demi"
+    PROFILES_FILE: str = "profiles.json"
+    OLD_DATA_TIMEOUT: float = 1800
+    NEW_DATA_TIMEOUT: float = 1800
+    PREFLIGHT: bool = False
+    PLAN_STATE: bool = False
+    SNAPSHOT_COPY: bool = False
+    SNAPSHOT_CACHE: bool = False
+    SNAPSHOT_CACHE_MAX_AGE: float = 24
+    DEACTIVATE_MISSING: bool = False
+    MISSING_MAX_FRACTION: float = 0.05
+    FEED_PARSER: str = "pandas"
+    VALIDATE: bool = False
 
     class Config:
         env_file = ".env"
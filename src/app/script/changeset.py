@@ -0,0 +1,122 @@
+import datetime
+import json
+import logging
+import math
+import os
+import shutil
+
+import pandas as pd
+
+__all__ = ["Changeset"]
+
+
+def como_valor(value):
+    """Plain text for a changeset cell (None stays None) so every column has one Parquet type."""
+    if value is None or value is pd.NaT or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, pd.Timestamp) and value == value.normalize():
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return str(value)
+
+
+def como_texto_frame(df: pd.DataFrame) -> pd.DataFrame:
+    # las columnas bool (cambio_*, es_principal) quedan como bool
+    return df.apply(lambda col: col if pd.api.types.is_bool_dtype(col) else col.map(como_valor).astype(object))
+
+
+class Changeset:
+    """
+    Everything a sync would write, computed without touching core: the rows
+    of every table an afiliado insert writes (FK order, ids already
+    assigned) and the resolved update stage, with its per-entity cambio_*
+    flags and plan/estado transitions. Stored as a directory with one
+    Parquet file per table plus a manifest.json that can be read before
+    applying it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self.inserts = {}
+        self.updates = []
+        self.manifest = {}
+
+    def add_inserts(self, tablas):
+        """Adds the (tabla, columnas, filas) of one build_insert_batch."""
+        for tabla, columnas, filas in tablas:
+            self.inserts.setdefault(tabla, []).append(como_texto_frame(pd.DataFrame(filas, columns=list(columnas))))
+
+    def add_updates(self, stage: pd.DataFrame):
+        self.updates.append(como_texto_frame(stage.reset_index(drop=True)))
+
+    def insert_frames(self):
+        """(tabla, frame) of every insert table, in the order they have to be written."""
+        for tabla in self.manifest.get("insert_order", list(self.inserts)):
+            frames = self.inserts.get(tabla, [])
+            if frames:
+                yield tabla, pd.concat(frames, ignore_index=True)
+
+    def update_frame(self) -> pd.DataFrame:
+        return pd.concat(self.updates, ignore_index=True) if self.updates else pd.DataFrame()
+
+    def save(self, fingerprints=None, **info):
+        """
+        Writes the changeset directory, replacing a previous one at the same
+        path. The FingerprintStore of the plan run goes along with it, to be
+        installed only once the changeset is applied.
+        """
+        tmp_path = f"{self.path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        tablas = {}
+        for tabla, frame in self.insert_frames():
+            frame.to_parquet(os.path.join(tmp_path, f"insert_{tabla}.parquet"), index=False)
+            tablas[tabla] = len(frame)
+        updates = self.update_frame()
+        updates.to_parquet(os.path.join(tmp_path, "update.parquet"), index=False)
+        self.manifest = {
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "applied_at": None,
+            "insert_order": list(tablas),
+            "inserts": tablas,
+            "updates": len(updates),
+            "cambios": {
+                columna.removeprefix("cambio_"): int(updates[columna].sum())
+                for columna in updates.columns if columna.startswith("cambio_")
+            },
+            **info,
+        }
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as manifest:
+            json.dump(self.manifest, manifest, indent=2)
+        if fingerprints is not None:
+            fingerprints.save(os.path.join(tmp_path, "fingerprints.npz"))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(tmp_path, self.path)
+        self.logger.info(f"Changeset written to {self.path}: {tablas.get('afiliado', 0)} inserts, {len(updates)} updates")
+
+    @classmethod
+    def load(cls, path: str) -> "Changeset":
+        changeset = cls(path)
+        with open(os.path.join(path, "manifest.json")) as manifest:
+            changeset.manifest = json.load(manifest)
+        for tabla in changeset.manifest["insert_order"]:
+            changeset.inserts[tabla] = [pd.read_parquet(os.path.join(path, f"insert_{tabla}.parquet"))]
+        changeset.updates = [pd.read_parquet(os.path.join(path, "update.parquet"))]
+        return changeset
+
+    @property
+    def fingerprints_path(self) -> str:
+        return os.path.join(self.path, "fingerprints.npz")
+
+    def mark_applied(self):
+        self.manifest["applied_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+        tmp_path = os.path.join(self.path, "manifest.json.tmp")
+        with open(tmp_path, "w") as manifest:
+            json.dump(self.manifest, manifest, indent=2)
+        os.replace(tmp_path, os.path.join(self.path, "manifest.json"))
@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+__all__ = ["CheckpointJournal"]
+
+
+class CheckpointJournal:
+    """
+    Append-only log of the NUMEROTARJETA committed by each batch, so an
+    interrupted run resumes without rewriting them. A journal belongs to
+    one run key (the feed being synced); opening it with another key
+    starts over. `identifies_feed` is False when the key could not be
+    derived from the feed itself (e.g. only the date), so the journaled rows
+    are not known to match the feed being synced now.
+    """
+
+    def __init__(self, path: str, run_key: str, identifies_feed: bool = True):
+        self.path = path
+        self.run_key = run_key
+        self.identifies_feed = identifies_feed
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.done = self.load()
+
+    def load(self) -> np.ndarray:
+        if not os.path.exists(self.path):
+            return np.array([], dtype="int64")
+        codigos = []
+        with open(self.path) as journal:
+            cabecera = json.loads(journal.readline() or "{}")
+            if cabecera.get("run") != self.run_key:
+                self.logger.info(f"Discarding checkpoint journal of run {cabecera.get('run')}")
+                os.remove(self.path)
+                return np.array([], dtype="int64")
+            for linea in journal:
+                try:
+                    codigos.extend(json.loads(linea)["codigos"])
+                except (ValueError, KeyError):
+                    # linea cortada por una corrida que se interrumpio escribiendo
+                    break
+        self.logger.info(f"Resuming run {self.run_key}: {len(codigos)} afiliados already committed")
+        return np.array(codigos, dtype="int64")
+
+    def record(self, fase: str, codigos):
+        """Appends one committed batch and syncs it to disk."""
+        with self.lock:
+            nuevo = not os.path.exists(self.path)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as journal:
+                if nuevo:
+                    journal.write(json.dumps({"run": self.run_key}) + "\n")
+                journal.write(json.dumps({"fase": fase, "codigos": [int(c) for c in codigos]}) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+
+    def clear(self):
+        """Drops the journal once the run finished without failed rows."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,15 +1,18 @@
 import datetime
 import io
 import math
-import sys
 import os
 import pytz
 from uuid import uuid4
 import logging
-import functools
+import contextlib
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import base64
 import os
 import psycopg2
+import psycopg2.pool
+from psycopg2.extras import execute_values
 import pandas as pd
 from ftplib import FTP
 import numpy as np
@@ -17,23 +20,70 @@ from unidecode import unidecode
 
 from app.core.settings import settings
 from app.core.database import connect
+from app.script.changeset import Changeset
+from app.script import plan_state
+from app.script.checkpoint import CheckpointJournal
+from app.script.feed_parser import read_feed
+from app.script.fingerprints import FingerprintStore
+from app.script.gazetteer import Gazetteer
+from app.script.metrics import CountingReader, Metrics, measured
+from app.script.profiles import DEMI, SyncProfile
+from app.script.progress import Progress
+from app.script.snapshot import load_snapshot
+from app.script.snapshot_cache import SnapshotCache
+from app.script.validation import Quarantine, rejection_reasons
+from app.script.schemas import (
+    CORE_COMPARE_COLUMNS,
+    CORE_DTYPES,
+    FEED_COMPARE_COLUMNS,
+    frame_mb,
+)
+
+BUENOS_AIRES_TZ = pytz.timezone("America/Argentina/Buenos_Aires")
+# bit de cada entidad en la mascara de cambios de compare_rows
+CAMBIOS = {
+    "persona": 1,
+    "documento": 2,
+    "titular": 4,
+    "plan": 8,
+    "estado": 16,
+    "domicilio": 32,
+    "telefono": 64,
+}
+# primer chunk del stream, con el que se estima cuanto pesa cada fila
+STREAM_FIRST_CHUNK_ROWS = 10000
+# copias de cada chunk que conviven mientras se estandariza, mergea y escribe
+STREAM_CHUNK_COPIES = 4
+
+
+def como_texto(value) -> str:
+    if value is None or value is pd.NaT or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y-%m-%d")
+    return str(value).strip()
+
+
+def titulares_primero(df: pd.DataFrame) -> pd.DataFrame:
+    # titulares primero, asi los dependientes encuentran a su titular (FK)
+    if "id_afi_nuevo" not in df.columns:
+        return df
+    es_dependiente = df["id_afiliado_titular_nuevo"] != df["id_afi_nuevo"]
+    return df.iloc[np.argsort(es_dependiente.to_numpy(), kind="stable")]
 
 
-def disable_print_if_verbose_decorator(func):
-    @functools.wraps(func)
-    def wrapper(self, *args, **kwargs):
-        if not getattr(self, "verbose", False):
-            original_stdout = sys.stdout
-            sys.stdout = open(os.devnull, "w")
-            try:
-                return func(self, *args, **kwargs)
-            finally:
-                sys.stdout.close()
-                sys.stdout = original_stdout
-        else:
-            return func(self, *args, **kwargs)
-
-    return wrapper
+def map_unique(col: pd.Series, func) -> pd.Series:
+    """
+    Applies func once per distinct value of col (NaN included) and maps the
+    results back to every row.
+    """
+    codes, uniques = pd.factorize(col, use_na_sentinel=False)
+    mapped = np.empty(len(uniques), dtype=object)
+    for i, value in enumerate(uniques):
+        mapped[i] = func(value)
+    return pd.Series(mapped[codes], index=col.index)
 
 
 class ScriptDemi:
@@ -42,45 +92,230 @@ class ScriptDemi:
         connection: psycopg2.extensions.connection,
         verbose: bool = False,
         ftp: bool = False,
+        bulk: bool = False,
+        bulk_update: bool = False,
+        batch_size: int = 5000,
+        stream: bool = False,
+        stream_memory_mb: int = 512,
+        fingerprints: FingerprintStore | None = None,
+        full_reconcile: bool = False,
+        gazetteer: Gazetteer | None = None,
+        pool: psycopg2.pool.ThreadedConnectionPool | None = None,
+        workers: int = 1,
+        checkpoint: CheckpointJournal | None = None,
+        metrics: Metrics | None = None,
+        changeset: Changeset | None = None,
+        progress_interval: float = 10.0,
+        progress_sample: int = 1000,
+        profile: SyncProfile = DEMI,
+        old_data_timeout: float = 0,
+        new_data_timeout: float = 0,
+        plan_state: bool = False,
+        snapshot_copy: bool = False,
+        snapshot_cache: SnapshotCache | None = None,
+        deactivate_missing: bool = False,
+        missing_max_fraction: float = 0.05,
+        feed_parser: str = "pandas",
+        quarantine: Quarantine | None = None,
     ):
+        # con metrics todos los cursores cuentan sus sentencias
+        self.metrics = metrics
+        if metrics is not None:
+            connection = metrics.wrap(connection)
         self.connection = connection
+        # financiadora, ubicacion del feed y mapas de planes/documentos
+        self.profile = profile
         self.verbose = verbose
         self.ftp = ftp
+        self.bulk = bulk
+        self.bulk_update = bulk_update
+        self.batch_size = batch_size
+        self.stream = stream
+        self.stream_memory_mb = stream_memory_mb
+        self.fingerprints = fingerprints
+        self.full_reconcile = full_reconcile
+        self.gazetteer = gazetteer
+        self.pool = pool
+        self.workers = workers
+        # con checkpoint cada lote de batch_size se commitea por separado
+        self.checkpoint = checkpoint
+        self.batch_commit = checkpoint is not None
+        # con changeset (modo plan) no se escribe en core, solo se junta lo que se escribiria
+        self.changeset = changeset
+        # los loops de escritura reportan cada progress_interval segundos y loguean 1 de cada progress_sample filas
+        self.progress_interval = progress_interval
+        self.progress_sample = progress_sample
+        # segundos maximos para el snapshot de core y para bajar/parsear el feed (0 = sin limite)
+        self.old_data_timeout = old_data_timeout
+        self.new_data_timeout = new_data_timeout
+        # con plan_state los writers mantienen afiliado_plan_actual y load_old_data lee de ahi
+        self.plan_state = plan_state
+        # con snapshot_copy las consultas del snapshot viajan por COPY TO STDOUT en vez de read_sql
+        self.snapshot_copy = snapshot_copy
+        # con snapshot_cache solo se releen de core los afiliados que cambiaron desde la corrida anterior
+        self.snapshot_cache = snapshot_cache
+        # con deactivate_missing los afiliados que ya no vienen en el feed pasan a INACTIVO,
+        # salvo que falte mas de missing_max_fraction de core (feed cortado o equivocado)
+        self.deactivate_missing = deactivate_missing
+        self.missing_max_fraction = missing_max_fraction
+        # backend de load_new_data (ver feed_parser): pandas o arrow multihilo
+        self.feed_parser = feed_parser
+        # con quarantine las filas que no pasan las reglas de validation no llegan a los writers
+        self.quarantine = quarantine
+        # NUMEROTARJETA (int) rechazados por validate
+        self.rechazados = []
+        # NUMEROTARJETA (int) que no se pudieron escribir
+        self.fallidos = []
+        # feed ya procesado en chunks anteriores, para resolver titulares entre chunks
+        self.feed_previo = None
         self.logger = logging.getLogger(__name__)
 
-    @disable_print_if_verbose_decorator
+    @measured
     def load_new_data(self) -> pd.DataFrame:
         ftp = self.ftp
         if ftp is True:
             try:
 
-                ftp = FTP(settings.BASE_FTP)
-                ftp.login(user=settings.FTP_USER, passwd=settings.FTP_PASSW)
-                print("✅ FTP login successful!")
+                ftp = self.ftp_login()
 
-                ftp.cwd("CredencialDigital")
+                ftp.cwd(self.profile.ftp_dir)
                 ftp_file = io.BytesIO()
 
-                ftp.retrbinary("RETR DEMISALUD-Afiliados.txt", ftp_file.write)
+                ftp.retrbinary(f"RETR {self.profile.feed_file}", ftp_file.write)
 
                 ftp_file.seek(0)
-                data = pd.read_csv(ftp_file, encoding="latin-1", sep="|")
+                self.record_bytes(ftp_file.getbuffer().nbytes)
+                data = read_feed(ftp_file, self.profile, self.feed_parser)
                 #data.to_csv("DEMISALUD-Afiliados-prod.txt")
                 ftp.quit()
-                print("FTP connection closed.")
+                self.logger.info("FTP connection closed.")
             except Exception as e:
-                print(f"❌ Error with FTP: {e}")
                 logging.error(f"Error with FTP: {e}")
+                raise
         else:
-            print("Loading data from local file...")
             logging.info("Loading data from local file...")
-            data = pd.read_csv("DEMISALUD-Afiliados.txt", encoding="latin-1", sep="|")
-            print("✅ Local Data loaded successfully!")
+            data = read_feed(self.profile.feed_file, self.profile, self.feed_parser)
+            self.record_bytes(os.path.getsize(self.profile.feed_file))
             logging.info("Data loaded successfully!")
             logging.info("-" * 30)
 
+        self.logger.info(f"Feed: {len(data)} rows, {frame_mb(data):.1f} MB")
         return data
 
+    def ftp_login(self) -> FTP:
+        # el timeout corta operaciones colgadas del socket de control y de datos
+        ftp = FTP(self.profile.ftp_host or settings.BASE_FTP, timeout=self.new_data_timeout or None)
+        ftp.login(user=self.profile.ftp_user or settings.FTP_USER, passwd=self.profile.ftp_password or settings.FTP_PASSW)
+        self.logger.info("FTP login successful!")
+        return ftp
+
+    def iter_new_data(self):
+        """
+        Streams the feed in chunks straight from the FTP data socket (or the
+        local file) into the csv parser. Chunk size is derived from
+        stream_memory_mb once the first chunk tells how much a row weighs.
+        """
+        ftp = None
+        conn = None
+        if self.ftp is True:
+            ftp = self.ftp_login()
+            ftp.cwd(self.profile.ftp_dir)
+            conn = ftp.transfercmd(f"RETR {self.profile.feed_file}")
+            source = conn.makefile("rb")
+        else:
+            self.logger.info("Streaming data from local file...")
+            source = open(self.profile.feed_file, "rb")
+        if self.metrics is not None:
+            source = CountingReader(source, self.metrics, "load_new_data")
+
+        try:
+            reader = pd.read_csv(source, iterator=True, **self.profile.read_csv_kwargs())
+            rows = STREAM_FIRST_CHUNK_ROWS
+            total = 0
+            while True:
+                try:
+                    chunk = self.profile.rename(reader.get_chunk(rows))
+                except StopIteration:
+                    break
+                if total == 0 and len(chunk) > 0:
+                    bytes_per_row = chunk.memory_usage(deep=True).sum() / len(chunk)
+                    budget = self.stream_memory_mb * 1024 * 1024
+                    rows = max(1000, int(budget / (bytes_per_row * STREAM_CHUNK_COPIES)))
+                    self.logger.info(f"Streaming feed in chunks of {rows} rows")
+                total += len(chunk)
+                yield chunk
+            self.logger.info(f"Feed streamed: {total} rows")
+        except Exception as e:
+            self.logger.error(f"Error streaming feed: {e}")
+            raise
+        finally:
+            source.close()
+            if conn is not None:
+                conn.close()
+                ftp.voidresp()
+                ftp.quit()
+                self.logger.info("FTP connection closed.")
+
+    def sync_streaming(self, old_data: pd.DataFrame) -> bool:
+        """
+        Runs compare_data chunk by chunk as the feed arrives. Each chunk is
+        inserted/updated in its own transaction. False if any write or the
+        retirement of the afiliados missing from the feed failed.
+        """
+        self.feed_previo = pd.DataFrame(columns=["ID_AFILIADO", "NUMEROTARJETA", "APELLIDO_NOMBRE", "id_afi"])
+        ok = True
+        try:
+            for chunk in self.iter_new_data():
+                ok &= self.compare_data(old_data, chunk)
+            # los que faltan solo se saben con el feed completo
+            if self.deactivate_missing:
+                _, removidos = self.classify(old_data, self.feed_previo)
+                ok &= self.retire_missing(old_data, removidos)
+        finally:
+            self.feed_previo = None
+        return ok
+
+    def load_data(self) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Runs load_old_data (core snapshot query) and load_new_data (feed
+        download and parse) in parallel and returns (old, new). The first
+        error of either side is raised as soon as it happens; a side that
+        runs past its timeout raises TimeoutError. The snapshot query is
+        cancelled and waited for first, so self.connection is idle again.
+        """
+        inicio = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"load-{self.profile.name}")
+        pendientes = {
+            executor.submit(self.load_old_data): ("core snapshot", self.old_data_timeout),
+            executor.submit(self.load_new_data): ("feed", self.new_data_timeout),
+        }
+        old, new = pendientes
+        try:
+            while pendientes:
+                limites = {f: inicio + timeout if timeout else math.inf for f, (_, timeout) in pendientes.items()}
+                espera = min(limites.values()) - time.monotonic()
+                listos, _ = wait(pendientes, timeout=None if espera == math.inf else max(espera, 0), return_when=FIRST_COMPLETED)
+                for futuro in listos:
+                    futuro.result()
+                    del pendientes[futuro]
+                for futuro, (nombre, timeout) in pendientes.items():
+                    if futuro not in listos and limites[futuro] <= time.monotonic():
+                        raise TimeoutError(f"Loading the {nombre} took more than {timeout}s")
+            return old.result(), new.result()
+        except BaseException:
+            if not old.done():
+                # el snapshot corre sobre self.connection: no puede volver al pool con la query viva
+                try:
+                    self.connection.cancel()
+                except Exception:
+                    self.logger.warning("Could not cancel the core snapshot query", exc_info=True)
+                wait([old])
+            raise
+        finally:
+            # un lado colgado no bloquea el error del otro; el FTP corta solo por el timeout del socket
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    @measured
     def load_old_data(self):
         """
         CSS col ref:
@@ -122,538 +357,856 @@ class ScriptDemi:
         'PISO',
         'DEPARTAMENTO',
         """
-        print("Querying data from core...")
-        logging.info("Querying data from core...")
-        query = """WITH RankedPlans AS (
-            SELECT
-                afiliado.id AS id_afi,
-                afiliado_plan.id AS id_afiliado_plan,
-                id_afiliado_titular,
-                persona.id AS id_persona,
-                codigo,
-                persona.nombre,
-                apellido,
-                genero_biologico,
-                fecha_nacimiento,
-                afiliado_parentezco_tipo.tipo AS tipo_parentezco,
-                persona_documento.id_param_documento_identificatorio,
-                persona_documento.valor AS n_documento,
-                param_documento_identificatorio.tipo AS tipo_doc,
-                domicilio.codigo_postal,
-                domicilio.calle,
-                domicilio.numeracion,
-                domicilio.piso,
-                domicilio.departamento,
-                contacto.id AS id_contacto,
-                contacto.tipo AS tipo_contacto,
-                contacto.valor AS telefono,
-                financiadora_plan.nombre AS nombre_plan,
-                financiadora_plan.id AS id_financiadora_plan,
-                ROW_NUMBER() OVER(
-                    PARTITION BY afiliado.id
-                    ORDER BY afiliado_plan.created_at DESC NULLS LAST
-                ) as rn
-            FROM afiliado
-            LEFT JOIN persona ON persona.id = afiliado.id_persona
-            LEFT JOIN persona_documento ON persona_documento.id_persona = persona.id
-            LEFT JOIN param_documento_identificatorio ON param_documento_identificatorio.id = persona_documento.id_param_documento_identificatorio
-            LEFT JOIN persona_contacto ON persona_contacto.id_persona = persona.id
-            LEFT JOIN contacto ON contacto.id = persona_contacto.id_contacto
-            LEFT JOIN persona_domicilio ON persona_domicilio.id_persona = persona.id
-            LEFT JOIN domicilio ON domicilio.id = persona_domicilio.id_domicilio
-            LEFT JOIN afiliado_parentezco_tipo ON afiliado_parentezco_tipo.id = afiliado.id_afiliado_parentezco_tipo
-            LEFT JOIN afiliado_plan ON afiliado_plan.id_afiliado = afiliado.id
-            LEFT JOIN financiadora_plan ON financiadora_plan.id = afiliado_plan.id_financiadora_plan
-            WHERE afiliado.id_financiadora = '69633cef-cd44-4ce2-ae8c-3000b61c6849'
-        ), RankedPlanEstados AS (
-            SELECT
-                afiliado_plan.id AS id_afiliado_plan,
-                afiliado_plan_estado.estado,
-                ROW_NUMBER() OVER(
-                    PARTITION BY afiliado_plan.id
-                    ORDER BY afiliado_plan_estado.fecha_desde DESC
-                ) as rn_estado
-            FROM afiliado_plan
-            LEFT JOIN afiliado_plan_estado ON afiliado_plan_estado.id_afiliado_plan = afiliado_plan.id
-        )
-        SELECT
-            rp.id_afi,
-            rp.id_afiliado_plan,
-            rp.id_afiliado_titular,
-            rp.id_persona,
-            rp.codigo,
-            rp.nombre,
-            rp.apellido,
-            rp.genero_biologico,
-            rp.fecha_nacimiento,
-            rp.tipo_parentezco,
-            rp.id_param_documento_identificatorio,
-            rp.n_documento,
-            rp.tipo_doc,
-            rp.tipo_contacto,
-            rp.id_contacto,
-            rp.telefono,
-            rp.codigo_postal,
-            rp.calle,
-            rp.numeracion,
-            rp.piso,
-            rp.departamento,
-            rp.nombre_plan,
-            rp.id_financiadora_plan,
-            COALESCE(rpe.estado, 'ACTIVO') as estado_actual
-        FROM RankedPlans rp
-        LEFT JOIN RankedPlanEstados rpe ON rpe.id_afiliado_plan = rp.id_afiliado_plan AND rpe.rn_estado = 1
-        WHERE rp.rn = 1"""
-        df = pd.read_sql(query, con=self.connection)
+        self.logger.info("Querying data from core...")
+        cursor = self.connection.cursor()
+        try:
+            if self.old_data_timeout:
+                cursor.execute("SET statement_timeout = %s", (int(self.old_data_timeout * 1000),))
+            # una consulta angosta por entidad, armadas con merges por clave (ver snapshot)
+            def loader(ids=None):
+                return load_snapshot(self.connection, self.profile.id_financiadora, self.plan_state, copy=self.snapshot_copy, ids=ids)
+
+            if self.snapshot_cache is not None:
+                df = self.snapshot_cache.refresh(self.connection, self.profile.id_financiadora, loader, self.plan_state)
+            else:
+                df = loader()
+            df = df.astype(CORE_DTYPES)
+            if self.old_data_timeout:
+                cursor.execute("RESET statement_timeout")
+        except Exception:
+            # el rollback tambien deshace el SET
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        self.logger.info(f"Core snapshot: {len(df)} rows, {frame_mb(df):.1f} MB")
         return df
 
     def generate_base32():
         return base64.b32encode(os.urandom(20)).decode("utf-8")
 
-    def insert_missing_afiliados(self, missing_df: pd.DataFrame):
-        cursor = self.connection.cursor()
+    @measured
+    def insert_missing_afiliados(self, missing_df: pd.DataFrame, connection=None, bulk: bool | None = None):
+        missing_df = titulares_primero(missing_df)
+        if self.bulk if bulk is None else bulk:
+            return self.insert_missing_afiliados_bulk(missing_df, connection)
+        connection = connection or self.connection
+        cursor = connection.cursor()
         # Asegurar que todos los NaN sean strings vacíos antes del insert
         missing_df.fillna("", inplace=True)
+        progress = self.progress("insert_missing_afiliados", len(missing_df))
         try:
             for row in missing_df.itertuples(index=False):
-                ########################################################################################################
-                # auth
-                auth_role_entity_query = """
-                INSERT INTO auth_role_entity (id, type)
-                VALUES (%s, %s)
-                """
-                id_afiliado = str(uuid4())
-                values_auth_role_entity = (id_afiliado, "afiliado")
-                cursor.execute(auth_role_entity_query, values_auth_role_entity)
-                ########################################################################################################
-                # persona
-                fecha_nacimiento = getattr(row, "FECHA_NACIMIENTO", "")
-                nombre = getattr(row, "NOMBRE", "")
-                apellido = getattr(row, "APELLIDO", "")
-                genero_out = getattr(row, "SEXO", "")
-                # persona
-                persona_query = """
-                INSERT INTO persona (nombre, apellido, fecha_nacimiento, genero_biologico)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
-                """
-                print(nombre, apellido, fecha_nacimiento, genero_out)
-                cursor.execute(
-                    persona_query, (nombre, apellido, fecha_nacimiento, genero_out)
-                )
-                id_persona = cursor.fetchone()[0]
-                ########################################################################################################
-                # persona_documento
-                valor = getattr(row, "NUMERODOCUMENTO", None)
-                id_param_documento_identificatorio = getattr(row, "TIPO_DOCUMENTO", "")
-                ########################################################################################################
-                # persona documento
-                id_persona_documento = str(uuid4())
-                persona_documento_query = """
-                INSERT INTO persona_documento (id, id_persona, id_param_documento_identificatorio, valor)
-                VALUES (%s, %s, %s, %s)
-                """
-                print(id_persona_documento)
-                print(valor)
-                print(id_param_documento_identificatorio)
-                print(id_persona)
-                cursor.execute(
-                    persona_documento_query,
-                    (
-                        id_persona_documento,
-                        id_persona,
-                        id_param_documento_identificatorio,
-                        valor,
-                    ),
-                )
-                ########################################################################################################
-                # domicilio
-                id_domicilio = str(uuid4())
-                codigo_postal = getattr(row, "CODIGO_POSTAL", "")
-                calle = getattr(row, "CALLE", "")
-                numeracion = getattr(row, "NUMERO")
-                piso = getattr(row, "PISO")
-                departamento = getattr(row, "DEPARTAMENTO")
-                desc = "NO"
-                id_loc_localidad = getattr(row, "id_loc_localidad")
-                domicilio_query = """
-                INSERT INTO domicilio (id, codigo_postal, calle, numeracion, piso, departamento, descripcion, id_loc_localidad)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """
-                vals_domicilio = (
-                    id_domicilio,
-                    codigo_postal,
-                    calle,
-                    numeracion,
-                    piso,
-                    departamento,
-                    desc,
-                    id_loc_localidad
-                )
-                cursor.execute(domicilio_query, vals_domicilio)
-                # persona domicilio
-                persona_domicilio_query = """
-                INSERT INTO persona_domicilio (id_persona, id_domicilio, es_principal)
-                VALUES (%s, %s, %s)
-                """
-                values_persona_domicilio = (
-                    id_persona,
-                    id_domicilio,
-                    True
-                )
-                cursor.execute(persona_domicilio_query, values_persona_domicilio)
-                ########################################################################################################
-                # afiliado
-                id_fina = "69633cef-cd44-4ce2-ae8c-3000b61c6849"
-                id_afiliado_titular = id_afiliado
-                codigo = str(getattr(row, "NUMEROTARJETA", ""))
-                opt_secret = base64.b32encode(os.urandom(20)).decode("utf-8")
-                afiliado_query = """
-                INSERT INTO afiliado (id, id_persona, id_afiliado_titular, codigo, id_financiadora, otp_secret)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                """
-                vals_afiliado = (
-                    id_afiliado,
-                    id_persona,
-                    id_afiliado_titular,
-                    codigo,
-                    id_fina,
-                    opt_secret,
-                )
-                cursor.execute(afiliado_query, vals_afiliado)
-                ########################################################################################################
-                #persona contacto
-                contacto_query = """
-                INSERT INTO contacto (id, valor, tipo)
-                VALUES (%s, %s, %s)
-                """
-                persona_contacto_query = """
-                INSERT INTO persona_contacto (id_persona, id_contacto)
-                VALUES (%s, %s)
-                """
+                escrito = self.write_row(cursor, self.insert_row, row)
+                progress.advance(errors=0 if escrito else 1, detail=lambda: row)
+
+            connection.commit()
+            progress.finish()
+            self.logger.info(f"Inserted {len(missing_df)} missing afiliados.")
+            return True
 
-                if getattr(row, "TELEFONO", "") != "NULL":
-                    id_contacto_telefono = str(uuid4())
+        except Exception as e:
+            connection.rollback()
+            self.logger.error("Failed to insert missing afiliados", exc_info=True)
+            return False
 
-                    values_contacto_telefono = (
-                        id_contacto_telefono,
-                        getattr(row, "TELEFONO", ""),
-                        "{LLAMADAS}"
-                    )
+        finally:
+            cursor.close()
 
-                    cursor.execute(contacto_query, values_contacto_telefono)
+    def stage(self, nombre: str):
+        """Context manager timing a block as a metrics stage (no-op without metrics)."""
+        if self.metrics is None:
+            return contextlib.nullcontext({})
+        return self.metrics.measure(nombre)
 
-                    values_persona_contacto_telefono = (
-                        id_persona,
-                        id_contacto_telefono
-                    )
+    def progress(self, nombre: str, total: int) -> Progress:
+        return Progress(f"{self.profile.name}/{nombre}", total, interval=self.progress_interval, sample=self.progress_sample)
 
-                    cursor.execute(persona_contacto_query, values_persona_contacto_telefono)
-
-                #if getattr(row, "EMAIL", "") != "NULL":
-                #    id_contacto_email = str(uuid4())
-#
-                #    values_contacto_email = (
-                #        id_contacto_email,
-                #        getattr(row, "EMAIL", ""),
-                #        "{EMAIL}"
-                #    )
-#
-                #    cursor.execute(contacto_query, values_contacto_email)
-#
-                #    values_persona_contacto_email = (
-                #        id_persona,
-                #        id_contacto_email
-                #    )
-#
-                #    cursor.execute(persona_contacto_query, values_persona_contacto_email)
-                ########################################################################################################
-                # afiliado plan
-                id_afiliado_plan = str(uuid4())
-                id_financiadora_plan = getattr(row, "NOMBRE_PLAN", "")
-                id_financiadora_plan_new = getattr(row, "NOMBRE_PLAN_NEW", "")
-                afiliado_plan_query = """
-                INSERT INTO afiliado_plan (id, id_afiliado, id_financiadora_plan)
-                VALUES (%s, %s, %s)
-                """
-                print(id_financiadora_plan_new)
-                cursor.execute(
-                    afiliado_plan_query,
-                    (id_afiliado_plan, id_afiliado, id_financiadora_plan_new),
-                )
-                plan_estado = "ACTIVO" if getattr(row, "MOROSO", "") =="NO" else "MOROSO"
-                insert_afiliado_plan_estado = """
-                INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
-                VALUES (%s, %s, %s, %s)
-                """
-                id_afiliado_plan_estado = str(uuid4())
-                buenos_aires_tz = pytz.timezone("America/Argentina/Buenos_Aires")
-
-                cursor.execute(
-                    insert_afiliado_plan_estado,
-                    (
-                        id_afiliado_plan_estado,
-                        id_afiliado_plan,
-                        plan_estado,
-                        str(datetime.datetime.now(buenos_aires_tz).date()),
-                    ),
-                )
+    def record_bytes(self, nbytes: int):
+        if self.metrics is not None:
+            self.metrics.record_bytes(nbytes, "load_new_data")
 
-            self.connection.commit()
+    def write_row(self, cursor, write, row) -> bool:
+        """
+        Runs write(cursor, row). In batch commit mode the row runs inside a
+        savepoint, so a failing row is rolled back, reported and skipped
+        instead of aborting its whole batch.
+        """
+        if not self.batch_commit:
+            write(cursor, row)
+            return True
+        cursor.execute("SAVEPOINT demi_fila")
+        try:
+            write(cursor, row)
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT demi_fila")
+            self.logger.warning(f"Skipping afiliado {row.NUMEROTARJETA}", exc_info=True)
+            self.fallidos.append(int(row.NUMEROTARJETA))
+            return False
+        cursor.execute("RELEASE SAVEPOINT demi_fila")
+        return True
+
+    def insert_row(self, cursor, row):
+        """Inserts one afiliado with its persona, documento, plan and contact rows."""
+        ########################################################################################################
+        # auth
+        auth_role_entity_query = """
+        INSERT INTO auth_role_entity (id, type)
+        VALUES (%s, %s)
+        """
+        id_afiliado = getattr(row, "id_afi_nuevo", "") or str(uuid4())
+        values_auth_role_entity = (id_afiliado, "afiliado")
+        cursor.execute(auth_role_entity_query, values_auth_role_entity)
+        ########################################################################################################
+        # persona
+        fecha_nacimiento = getattr(row, "FECHA_NACIMIENTO", "")
+        nombre = getattr(row, "NOMBRE", "")
+        apellido = getattr(row, "APELLIDO", "")
+        genero_out = getattr(row, "SEXO", "")
+        # persona
+        persona_query = """
+        INSERT INTO persona (nombre, apellido, fecha_nacimiento, genero_biologico)
+        VALUES (%s, %s, %s, %s)
+        RETURNING id
+        """
+        cursor.execute(
+            persona_query, (nombre, apellido, fecha_nacimiento, genero_out)
+        )
+        id_persona = cursor.fetchone()[0]
+        ########################################################################################################
+        # persona_documento
+        valor = getattr(row, "NUMERODOCUMENTO", None)
+        id_param_documento_identificatorio = getattr(row, "TIPO_DOCUMENTO", "")
+        ########################################################################################################
+        # persona documento
+        id_persona_documento = str(uuid4())
+        persona_documento_query = """
+        INSERT INTO persona_documento (id, id_persona, id_param_documento_identificatorio, valor)
+        VALUES (%s, %s, %s, %s)
+        """
+        cursor.execute(
+            persona_documento_query,
+            (
+                id_persona_documento,
+                id_persona,
+                id_param_documento_identificatorio,
+                valor,
+            ),
+        )
+        ########################################################################################################
+        # domicilio
+        id_domicilio = str(uuid4())
+        codigo_postal = getattr(row, "CODIGO_POSTAL", "")
+        calle = getattr(row, "CALLE", "")
+        numeracion = getattr(row, "NUMERO")
+        piso = getattr(row, "PISO")
+        departamento = getattr(row, "DEPARTAMENTO")
+        desc = "NO"
+        id_loc_localidad = getattr(row, "id_loc_localidad")
+        domicilio_query = """
+        INSERT INTO domicilio (id, codigo_postal, calle, numeracion, piso, departamento, descripcion, id_loc_localidad)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        vals_domicilio = (
+            id_domicilio,
+            codigo_postal,
+            calle,
+            numeracion,
+            piso,
+            departamento,
+            desc,
+            id_loc_localidad
+        )
+        cursor.execute(domicilio_query, vals_domicilio)
+        # persona domicilio
+        persona_domicilio_query = """
+        INSERT INTO persona_domicilio (id_persona, id_domicilio, es_principal)
+        VALUES (%s, %s, %s)
+        """
+        values_persona_domicilio = (
+            id_persona,
+            id_domicilio,
+            True
+        )
+        cursor.execute(persona_domicilio_query, values_persona_domicilio)
+        ########################################################################################################
+        # afiliado
+        id_fina = self.profile.id_financiadora
+        id_afiliado_titular = getattr(row, "id_afiliado_titular_nuevo", "") or id_afiliado
+        codigo = str(getattr(row, "NUMEROTARJETA", ""))
+        opt_secret = base64.b32encode(os.urandom(20)).decode("utf-8")
+        afiliado_query = """
+        INSERT INTO afiliado (id, id_persona, id_afiliado_titular, codigo, id_financiadora, otp_secret)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """
+        vals_afiliado = (
+            id_afiliado,
+            id_persona,
+            id_afiliado_titular,
+            codigo,
+            id_fina,
+            opt_secret,
+        )
+        cursor.execute(afiliado_query, vals_afiliado)
+        ########################################################################################################
+        #persona contacto
+        contacto_query = """
+        INSERT INTO contacto (id, valor, tipo)
+        VALUES (%s, %s, %s)
+        """
+        persona_contacto_query = """
+        INSERT INTO persona_contacto (id_persona, id_contacto)
+        VALUES (%s, %s)
+        """
+
+        if getattr(row, "TELEFONO", "") != "NULL":
+            id_contacto_telefono = str(uuid4())
+
+            values_contacto_telefono = (
+                id_contacto_telefono,
+                getattr(row, "TELEFONO", ""),
+                "{LLAMADAS}"
+            )
+
+            cursor.execute(contacto_query, values_contacto_telefono)
+
+            values_persona_contacto_telefono = (
+                id_persona,
+                id_contacto_telefono
+            )
+
+            cursor.execute(persona_contacto_query, values_persona_contacto_telefono)
+
+        #if getattr(row, "EMAIL", "") != "NULL":
+        #    id_contacto_email = str(uuid4())
+
+        #    values_contacto_email = (
+        #        id_contacto_email,
+        #        getattr(row, "EMAIL", ""),
+        #        "{EMAIL}"
+        #    )
+
+        #    cursor.execute(contacto_query, values_contacto_email)
+
+        #    values_persona_contacto_email = (
+        #        id_persona,
+        #        id_contacto_email
+        #    )
+
+        #    cursor.execute(persona_contacto_query, values_persona_contacto_email)
+        ########################################################################################################
+        # afiliado plan
+        id_afiliado_plan = str(uuid4())
+        id_financiadora_plan = getattr(row, "NOMBRE_PLAN", "")
+        id_financiadora_plan_new = getattr(row, "NOMBRE_PLAN_NEW", "")
+        afiliado_plan_query = """
+        INSERT INTO afiliado_plan (id, id_afiliado, id_financiadora_plan)
+        VALUES (%s, %s, %s)
+        """
+        cursor.execute(
+            afiliado_plan_query,
+            (id_afiliado_plan, id_afiliado, id_financiadora_plan_new),
+        )
+        plan_estado = "ACTIVO" if getattr(row, "MOROSO", "") =="NO" else "MOROSO"
+        insert_afiliado_plan_estado = """
+        INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
+        VALUES (%s, %s, %s, %s)
+        """
+        id_afiliado_plan_estado = str(uuid4())
+
+        cursor.execute(
+            insert_afiliado_plan_estado,
+            (
+                id_afiliado_plan_estado,
+                id_afiliado_plan,
+                plan_estado,
+                str(datetime.datetime.now(BUENOS_AIRES_TZ).date()),
+            ),
+        )
+        if self.plan_state:
+            plan_state.refresh_afiliados(cursor, [id_afiliado])
+
+    def insert_missing_afiliados_bulk(self, missing_df: pd.DataFrame, connection=None):
+        """
+        Same rows as insert_missing_afiliados, but every id is generated here
+        and each table gets one multi-row INSERT per batch, in FK order.
+        """
+        connection = connection or self.connection
+        cursor = connection.cursor()
+        # Asegurar que todos los NaN sean strings vacíos antes del insert
+        missing_df.fillna("", inplace=True)
+        hoy = str(datetime.datetime.now(BUENOS_AIRES_TZ).date())
+        progress = self.progress("insert_missing_afiliados_bulk", len(missing_df))
+        try:
+            for start in range(0, len(missing_df), self.batch_size):
+                batch = missing_df.iloc[start:start + self.batch_size]
+                ids_afiliado = []
+                for tabla, columnas, filas in self.build_insert_batch(batch, hoy):
+                    if not filas:
+                        continue
+                    execute_values(
+                        cursor,
+                        f"INSERT INTO {tabla} ({', '.join(columnas)}) VALUES %s",
+                        filas,
+                        page_size=len(filas),
+                    )
+                    if tabla == "afiliado":
+                        ids_afiliado = [fila[0] for fila in filas]
+                if self.plan_state:
+                    plan_state.refresh_afiliados(cursor, ids_afiliado)
+                progress.advance(len(batch))
+
+            connection.commit()
+            progress.finish()
             self.logger.info(f"Inserted {len(missing_df)} missing afiliados.")
+            return True
 
         except Exception as e:
-            self.connection.rollback()
+            connection.rollback()
             self.logger.error("Failed to insert missing afiliados", exc_info=True)
+            return False
 
         finally:
             cursor.close()
 
+    def build_insert_batch(self, batch: pd.DataFrame, hoy: str):
+        """
+        Returns (tabla, columnas, filas) for every table written by an
+        afiliado insert, in FK order.
+        """
+        n = len(batch)
 
-    def update_rows(self, df: pd.DataFrame):
-        cursor = self.connection.cursor()
+        def new_ids():
+            return [str(uuid4()) for _ in range(n)]
+
+        def col(name, default=""):
+            if name in batch.columns:
+                return batch[name].tolist()
+            return [default] * n
+
+        id_afiliado = [id_afi or str(uuid4()) for id_afi in col("id_afi_nuevo")]
+        id_afiliado_titular = [
+            id_titular or id_afi for id_titular, id_afi in zip(col("id_afiliado_titular_nuevo"), id_afiliado)
+        ]
+        id_persona = new_ids()
+        id_persona_documento = new_ids()
+        id_domicilio = new_ids()
+        id_afiliado_plan = new_ids()
+        id_afiliado_plan_estado = new_ids()
+        otp_secrets = [base64.b32encode(os.urandom(20)).decode("utf-8") for _ in range(n)]
+        codigos = [str(x) for x in col("NUMEROTARJETA")]
+        telefonos = col("TELEFONO")
+        plan_estados = ["ACTIVO" if x == "NO" else "MOROSO" for x in col("MOROSO")]
+
+        # solo telefono en demi, los "NULL" no se cargan
+        con_telefono = [i for i, tel in enumerate(telefonos) if tel != "NULL"]
+        id_contacto = {i: str(uuid4()) for i in con_telefono}
+
+        return [
+            (
+                "auth_role_entity",
+                ("id", "type"),
+                [(id_afi, "afiliado") for id_afi in id_afiliado],
+            ),
+            (
+                "persona",
+                ("id", "nombre", "apellido", "fecha_nacimiento", "genero_biologico"),
+                list(zip(id_persona, col("NOMBRE"), col("APELLIDO"), col("FECHA_NACIMIENTO"), col("SEXO"))),
+            ),
+            (
+                "persona_documento",
+                ("id", "id_persona", "id_param_documento_identificatorio", "valor"),
+                list(zip(id_persona_documento, id_persona, col("TIPO_DOCUMENTO"), col("NUMERODOCUMENTO", None))),
+            ),
+            (
+                "domicilio",
+                ("id", "codigo_postal", "calle", "numeracion", "piso", "departamento", "descripcion", "id_loc_localidad"),
+                list(zip(
+                    id_domicilio,
+                    col("CODIGO_POSTAL"),
+                    col("CALLE"),
+                    col("NUMERO"),
+                    col("PISO"),
+                    col("DEPARTAMENTO"),
+                    ["NO"] * n,
+                    col("id_loc_localidad"),
+                )),
+            ),
+            (
+                "persona_domicilio",
+                ("id_persona", "id_domicilio", "es_principal"),
+                [(id_per, id_dom, True) for id_per, id_dom in zip(id_persona, id_domicilio)],
+            ),
+            (
+                "afiliado",
+                ("id", "id_persona", "id_afiliado_titular", "codigo", "id_financiadora", "otp_secret"),
+                list(zip(id_afiliado, id_persona, id_afiliado_titular, codigos, [self.profile.id_financiadora] * n, otp_secrets)),
+            ),
+            (
+                "contacto",
+                ("id", "valor", "tipo"),
+                [(id_contacto[i], telefonos[i], "{LLAMADAS}") for i in con_telefono],
+            ),
+            (
+                "persona_contacto",
+                ("id_persona", "id_contacto"),
+                [(id_persona[i], id_contacto[i]) for i in con_telefono],
+            ),
+            (
+                "afiliado_plan",
+                ("id", "id_afiliado", "id_financiadora_plan"),
+                list(zip(id_afiliado_plan, id_afiliado, col("NOMBRE_PLAN_NEW"))),
+            ),
+            (
+                "afiliado_plan_estado",
+                ("id", "id_afiliado_plan", "estado", "fecha_desde"),
+                list(zip(id_afiliado_plan_estado, id_afiliado_plan, plan_estados, [hoy] * n)),
+            ),
+        ]
+
+
+    @measured
+    def update_rows(self, df: pd.DataFrame, connection=None, bulk: bool | None = None):
+        if self.bulk_update if bulk is None else bulk:
+            return self.update_rows_bulk(df, connection)
+        connection = connection or self.connection
+        cursor = connection.cursor()
         # Asegurar que todos los NaN sean strings vacíos antes del update
         # df.fillna("", inplace=True)
-        print(f"Updating {len(df)} rows")
+        progress = self.progress("update_rows", len(df))
         try:
             for row in df.itertuples(index=True):
-                # Check persona data
-                #print(row)
-                #print("updating persona")
-                #row = dict(row)
-                persona_data = {
-                    "nombre": row.NOMBRE if row.NOMBRE != row.nombre and row.nombre is not None and (row.NOMBRE is not None and len(row.NOMBRE) > 0) else row.nombre,
-                    "apellido": row.APELLIDO if row.APELLIDO != row.apellido and row.apellido is not None and (row.APELLIDO is not None and len(row.APELLIDO) > 0) else row.apellido,
-                    "genero_biologico": row.SEXO if row.SEXO != row.genero_biologico and (row.SEXO is not None and len(row.SEXO) > 0) else row.genero_biologico,
-                    "fecha_nacimiento": row.FECHA_NACIMIENTO if row.FECHA_NACIMIENTO != row.fecha_nacimiento and row.FECHA_NACIMIENTO is not None else row.fecha_nacimiento
-                }
-
-                #if not all(self.is_valid(value) for value in persona_data.values()):
-                #    print(f"Skipping update for persona due to invalid data: {persona_data}")
-                #    continue
-
-                set_clause = ", ".join([f"{key} = %s" for key in persona_data.keys()])
-                update_persona_query = f"""
-                    UPDATE persona
-                    SET {set_clause}
-                    WHERE id = %s
-                """
-                values = list(persona_data.values()) + [getattr(row, "id_persona", "")]
-                cursor.execute(update_persona_query, values)
-
-                #print("updating persona documento")
-                persona_documento_data = {
-                    "valor": row.NUMERODOCUMENTO if row.NUMERODOCUMENTO != row.n_documento and row.NUMERODOCUMENTO is not None else row.n_documento,
-                    "id_param_documento_identificatorio": row.TIPO_DOCUMENTO if row.TIPO_DOCUMENTO != row.id_param_documento_identificatorio and row.id_param_documento_identificatorio is not None else row.id_param_documento_identificatorio,
+                escrito = self.write_row(cursor, self.update_row, row)
+                progress.advance(errors=0 if escrito else 1, detail=lambda: row)
 
-                }
+            connection.commit()
+            progress.finish()
+            return True
 
-                #if not all(self.is_valid(value) for value in persona_documento_data.values()):
-                #    print(f"Skipping update for persona_documento due to invalid data: {persona_documento_data}")
-                #    continue  # Skip this row if any field is invalid
+        except Exception as e:
+            connection.rollback()
+            self.logger.error("Failed to update afiliados", exc_info=True)
+            return False
+        finally:
+            cursor.close()
 
-                set_clause = ", ".join([f"{key} = %s" for key in persona_documento_data.keys()])
-                update_persona_documento_query = f"""
-                    UPDATE persona_documento
-                    SET {set_clause}
-                    WHERE id_persona = %s
+    def update_row(self, cursor, row):
+        """Applies the changes of one comparison row to every core table."""
+        def cambia(row, entidad):
+            # sin la mascara de compare_rows se actualiza todo, como antes
+            return getattr(row, f"cambio_{entidad}", True)
+
+        # Check persona data
+        #print(row)
+        #print("updating persona")
+        #row = dict(row)
+        if cambia(row, "persona"):
+            persona_data = {
+                "nombre": row.NOMBRE if row.NOMBRE != row.nombre and row.nombre is not None and (row.NOMBRE is not None and len(row.NOMBRE) > 0) else row.nombre,
+                "apellido": row.APELLIDO if row.APELLIDO != row.apellido and row.apellido is not None and (row.APELLIDO is not None and len(row.APELLIDO) > 0) else row.apellido,
+                "genero_biologico": row.SEXO if row.SEXO != row.genero_biologico and (row.SEXO is not None and len(row.SEXO) > 0) else row.genero_biologico,
+                "fecha_nacimiento": row.FECHA_NACIMIENTO if row.FECHA_NACIMIENTO != row.fecha_nacimiento and row.FECHA_NACIMIENTO is not None else row.fecha_nacimiento
+            }
+
+            #if not all(self.is_valid(value) for value in persona_data.values()):
+            #    print(f"Skipping update for persona due to invalid data: {persona_data}")
+            #    continue
+
+            set_clause = ", ".join([f"{key} = %s" for key in persona_data.keys()])
+            update_persona_query = f"""
+                UPDATE persona
+                SET {set_clause}
+                WHERE id = %s
+            """
+            values = list(persona_data.values()) + [getattr(row, "id_persona", "")]
+            cursor.execute(update_persona_query, values)
+
+        #print("updating persona documento")
+        if cambia(row, "documento"):
+            persona_documento_data = {
+                "valor": row.NUMERODOCUMENTO if row.NUMERODOCUMENTO != row.n_documento and row.NUMERODOCUMENTO is not None else row.n_documento,
+                "id_param_documento_identificatorio": row.TIPO_DOCUMENTO if row.TIPO_DOCUMENTO != row.id_param_documento_identificatorio and row.id_param_documento_identificatorio is not None else row.id_param_documento_identificatorio,
+
+            }
+
+            #if not all(self.is_valid(value) for value in persona_documento_data.values()):
+            #    print(f"Skipping update for persona_documento due to invalid data: {persona_documento_data}")
+            #    continue  # Skip this row if any field is invalid
+
+            set_clause = ", ".join([f"{key} = %s" for key in persona_documento_data.keys()])
+            update_persona_documento_query = f"""
+                UPDATE persona_documento
+                SET {set_clause}
+                WHERE id_persona = %s
+            """
+            values = list(persona_documento_data.values()) + [getattr(row, "id_persona", "")]
+            cursor.execute(update_persona_documento_query, values)
+
+        #print("updating afiliado")
+        if cambia(row, "titular"):
+            # el titular ya viene resuelto por resolve_titulares
+            id_titular = getattr(row, "id_afiliado_titular_nuevo", "")
+            if id_titular:
+                update_afiliado_query = """
+                    UPDATE afiliado
+                    SET id_afiliado_titular = %s
+                    WHERE id = %s
                 """
-                values = list(persona_documento_data.values()) + [getattr(row, "id_persona", "")]
-                cursor.execute(update_persona_documento_query, values)
+                cursor.execute(update_afiliado_query, (id_titular, row.id_afi))
+            else:
+                self.logger.debug(f"No titular found for afiliado {row.NUMEROTARJETA}")
+
+        ########################################################################################################
+        # domicilio
+        if cambia(row, "domicilio"):
+            update_domicilio_query="""
+                UPDATE domicilio
+                SET
+                codigo_postal = %s,
+                calle = %s,
+                numeracion = %s,
+                piso = %s,
+                departamento = %s,
+                descripcion = %s,
+                id_loc_localidad = %s
+                WHERE
+                domicilio.id = %s
+            """
+
+            domicilio_data = {
+                "codigo_postal": row.CODIGO_POSTAL if row.CODIGO_POSTAL != "NaN" else "",
+                "calle":row.CALLE if row.CALLE != "NaN" else "",
+                "numeracion":row.NUMERO if row.NUMERO != "NaN" else "",
+                "piso":row.PISO if row.PISO != "NaN" else "",
+                "departamento":row.DEPARTAMENTO if row.DEPARTAMENTO != "NaN" else "",
+                "descripcion":"",
+                "id_loc_localidad":row.id_loc_localidad
+            }
+            # el domicilio que eligio el snapshot (el principal), no todos los de la persona
+            values = list(domicilio_data.values()) + [getattr(row, "id_domicilio", None)]
+            cursor.execute(update_domicilio_query, values)
+        ########################################################################################################
+        #persona contacto, solo telefono en demi
+
+        if cambia(row, "telefono"):
+            update_contacto_query = """UPDATE contacto SET valor = %s WHERE contacto.id = %s"""
+            telefono_data = {
+                "valor": row.TELEFONO if row.TELEFONO != "NaN" else ""
+            }
+
+            values = list(telefono_data.values()) + [getattr(row, "id_contacto", "")]
+            cursor.execute(update_contacto_query, values)
+        #print("inserting into afiliado_plan")
+        plan_estado_esperado = "ACTIVO" if row.MOROSO == "NO" else "MOROSO"
+
+        if getattr(row, "cambio_plan", row.NOMBRE_PLAN_NEW != row.id_financiadora_plan):
+            #print("previous plan is deprecated, creating new status for old plan")
+            old_plan_status_id = str(uuid4())
+            insert_afiliado_plan_estado_query = """
+            INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
+            VALUES (%s, %s, %s, %s)
+            """
+            cursor.execute(
+                insert_afiliado_plan_estado_query,
+                (
+                    old_plan_status_id,
+                    row.id_afiliado_plan,
+                    "INACTIVO",
+                    str(datetime.datetime.now(BUENOS_AIRES_TZ).date())
+                )
+            )
+            #print("Inserting new plan and status entry")
+            new_plan_id = str(uuid4())
+            insert_afiliado_plan_query = """
+            INSERT INTO afiliado_plan (id, id_afiliado, id_financiadora_plan)
+            VALUES (%s, %s, %s)
+            """
+            cursor.execute(
+                insert_afiliado_plan_query,
+                (
+                    new_plan_id,
+                    row.id_afi,
+                    row.NOMBRE_PLAN_NEW
+                )
+            )
+            new_plan_status_id = str(uuid4())
+            insert_afiliado_plan_estado_query = """
+            INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
+            VALUES (%s, %s, %s, %s)
+            """
+            cursor.execute(
+                insert_afiliado_plan_estado_query,
+                (
+                    new_plan_status_id,
+                    new_plan_id,
+                    plan_estado_esperado,
+                    str(datetime.datetime.now(BUENOS_AIRES_TZ).date())
+                )
+            )
+            if self.plan_state:
+                plan_state.refresh_afiliados(cursor, [row.id_afi])
+        elif getattr(row, "cambio_estado", plan_estado_esperado != row.estado_actual):
+            #print("Plan unchanged but status different, updating status")
+            new_status_id = str(uuid4())
+            insert_afiliado_plan_estado_query = """
+            INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
+            VALUES (%s, %s, %s, %s)
+            """
+            cursor.execute(
+                insert_afiliado_plan_estado_query,
+                (
+                    new_status_id,
+                    row.id_afiliado_plan,
+                    plan_estado_esperado,
+                    str(datetime.datetime.now(BUENOS_AIRES_TZ).date())
+                )
+            )
+            if self.plan_state:
+                plan_state.refresh_afiliados(cursor, [row.id_afi])
 
-                #print("updating afiliado")
-                codigo_titular = row.TITULAR_TARJETA if row.TITULAR_TARJETA != row.codigo_titular and row.TITULAR_TARJETA is not None else row.codigo_titular
 
-                if isinstance(codigo_titular, (int, float)) and (math.isnan(codigo_titular) or codigo_titular == ""):
-                    codigo_titular = row.codigo_titular
-                    #print(f"Skipping update for afiliado: invalid codigo_titular {codigo_titular}")
-                    #continue
 
-                #if not self.is_valid(codigo_titular):
-                #    print(f"Skipping update for afiliado: invalid codigo_titular {codigo_titular}")
-                #    continue
+    def build_update_stage(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Resolves, column by column, the values update_rows would write for
+        every row, in the column order of the staging table.
+        """
+        def differs(new, old):
+            return (new != old) & new.notna()
 
-                id_titular_query = """
-                    SELECT id FROM afiliado
-                    WHERE codigo = %s
-                    AND id_financiadora = '69633cef-cd44-4ce2-ae8c-3000b61c6849'
-                """
-                cursor.execute(id_titular_query, (codigo_titular,))
-                result = cursor.fetchone()
-
-                if result:
-                    id_titular = result[0]
-                    update_afiliado_query = """
-                        UPDATE afiliado
-                        SET id_afiliado_titular = %s
-                        WHERE id = %s
-                    """
-                    cursor.execute(update_afiliado_query, (id_titular, row.id_afi))
-                else:
-                    print("No record found for the given codigo_titular.")
-
-                ########################################################################################################
-                # domicilio
-                update_domicilio_query="""
-                    UPDATE domicilio
-                    SET
-                    codigo_postal = %s,
-                    calle = %s,
-                    numeracion = %s,
-                    piso = %s,
-                    departamento = %s,
-                    descripcion = %s,
-                    id_loc_localidad = %s
-                    WHERE
-                    domicilio.id = (
-                                SELECT
-                                persona_domicilio.id_domicilio
-                                FROM
-                                persona_domicilio
-                                WHERE
-                                persona_domicilio.id_persona = %s
-                                )
-                """
+        def not_empty(col):
+            return col.notna() & (col.astype(str).str.len() > 0)
 
-                domicilio_data = {
-                    "codigo_postal": row.CODIGO_POSTAL if row.CODIGO_POSTAL != "NaN" else "",
-                    "calle":row.CALLE if row.CALLE != "NaN" else "",
-                    "numeracion":row.NUMERO if row.NUMERO != "NaN" else "",
-                    "piso":row.PISO if row.PISO != "NaN" else "",
-                    "departamento":row.DEPARTAMENTO if row.DEPARTAMENTO != "NaN" else "",
-                    "descripcion":"",
-                    "id_loc_localidad":row.id_loc_localidad
-                }
-                values = list(domicilio_data.values()) + [getattr(row, "id_persona", "")]
-                cursor.execute(update_domicilio_query, values)
-                ########################################################################################################
-                #persona contacto, solo telefono en demi
-
-                update_contacto_query = """UPDATE contacto SET valor = %s WHERE contacto.id = %s"""
-                telefono_data = {
-                    "valor": row.TELEFONO if row.TELEFONO != "NaN" else ""
-                }
-
-                values = list(telefono_data.values()) + [getattr(row, "id_contacto", "")]
-                cursor.execute(update_contacto_query, values)
-                #print("inserting into afiliado_plan")
-                buenos_aires_tz = pytz.timezone("America/Argentina/Buenos_Aires")
-                plan_estado_esperado = "ACTIVO" if row.MOROSO == "NO" else "MOROSO"
-
-                if row.NOMBRE_PLAN_NEW != row.id_financiadora_plan:
-                    #print("previous plan is deprecated, creating new status for old plan")
-                    old_plan_status_id = str(uuid4())
-                    insert_afiliado_plan_estado_query = """
-                    INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
-                    VALUES (%s, %s, %s, %s)
-                    """
-                    cursor.execute(
-                        insert_afiliado_plan_estado_query,
-                        (
-                            old_plan_status_id,
-                            row.id_afiliado_plan,
-                            "INACTIVO",
-                            str(datetime.datetime.now(buenos_aires_tz).date())
-                        )
-                    )
-                    #print("Inserting new plan and status entry")
-                    new_plan_id = str(uuid4())
-                    insert_afiliado_plan_query = """
-                    INSERT INTO afiliado_plan (id, id_afiliado, id_financiadora_plan)
-                    VALUES (%s, %s, %s)
-                    """
-                    cursor.execute(
-                        insert_afiliado_plan_query,
-                        (
-                            new_plan_id,
-                            row.id_afi,
-                            row.NOMBRE_PLAN_NEW
-                        )
-                    )
-                    new_plan_status_id = str(uuid4())
-                    insert_afiliado_plan_estado_query = """
-                    INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
-                    VALUES (%s, %s, %s, %s)
-                    """
-                    cursor.execute(
-                        insert_afiliado_plan_estado_query,
-                        (
-                            new_plan_status_id,
-                            new_plan_id,
-                            plan_estado_esperado,
-                            str(datetime.datetime.now(buenos_aires_tz).date())
-                        )
-                    )
-                elif plan_estado_esperado != row.estado_actual:
-                    #print("Plan unchanged but status different, updating status")
-                    new_status_id = str(uuid4())
-                    insert_afiliado_plan_estado_query = """
-                    INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
-                    VALUES (%s, %s, %s, %s)
-                    """
-                    cursor.execute(
-                        insert_afiliado_plan_estado_query,
-                        (
-                            new_status_id,
-                            row.id_afiliado_plan,
-                            plan_estado_esperado,
-                            str(datetime.datetime.now(buenos_aires_tz).date())
-                        )
-                    )
+        def sin_nan(col):
+            return col.mask(col == "NaN", "")
 
-            self.connection.commit()
+        n = len(df)
+        stage = pd.DataFrame(index=df.index)
+        stage["id_afi"] = df["id_afi"]
+        stage["id_persona"] = df["id_persona"]
+        stage["nombre"] = df["NOMBRE"].where(
+            differs(df["NOMBRE"], df["nombre"]) & df["nombre"].notna() & not_empty(df["NOMBRE"]), df["nombre"]
+        )
+        stage["apellido"] = df["APELLIDO"].where(
+            differs(df["APELLIDO"], df["apellido"]) & df["apellido"].notna() & not_empty(df["APELLIDO"]), df["apellido"]
+        )
+        stage["genero_biologico"] = df["SEXO"].where(
+            differs(df["SEXO"], df["genero_biologico"]) & not_empty(df["SEXO"]), df["genero_biologico"]
+        )
+        stage["fecha_nacimiento"] = df["FECHA_NACIMIENTO"].where(
+            differs(df["FECHA_NACIMIENTO"], df["fecha_nacimiento"]), df["fecha_nacimiento"]
+        )
+        stage["documento_valor"] = df["NUMERODOCUMENTO"].where(
+            differs(df["NUMERODOCUMENTO"], df["n_documento"]), df["n_documento"]
+        )
+        stage["id_param_documento_identificatorio"] = df["TIPO_DOCUMENTO"].where(
+            (df["TIPO_DOCUMENTO"] != df["id_param_documento_identificatorio"])
+            & df["id_param_documento_identificatorio"].notna(),
+            df["id_param_documento_identificatorio"],
+        )
+        stage["id_afiliado_titular"] = df["id_afiliado_titular_nuevo"].replace("", None)
+        stage["id_domicilio"] = df["id_domicilio"]
+        stage["codigo_postal"] = sin_nan(df["CODIGO_POSTAL"])
+        stage["calle"] = sin_nan(df["CALLE"])
+        stage["numeracion"] = sin_nan(df["NUMERO"])
+        stage["piso"] = sin_nan(df["PISO"])
+        stage["departamento"] = sin_nan(df["DEPARTAMENTO"])
+        stage["id_loc_localidad"] = df["id_loc_localidad"]
+        stage["id_contacto"] = df["id_contacto"]
+        stage["telefono"] = sin_nan(df["TELEFONO"])
+
+        estado_esperado = np.where(df["MOROSO"] == "NO", "ACTIVO", "MOROSO")
+        cambio_plan = df["NOMBRE_PLAN_NEW"] != df["id_financiadora_plan"]
+        stage["id_afiliado_plan"] = df["id_afiliado_plan"]
+        stage["id_estado_cierre"] = [str(uuid4()) for _ in range(n)]
+        stage["id_afiliado_plan_nuevo"] = [str(uuid4()) for _ in range(n)]
+        stage["id_financiadora_plan_nuevo"] = df["NOMBRE_PLAN_NEW"]
+        stage["id_estado_nuevo"] = [str(uuid4()) for _ in range(n)]
+        stage["estado_esperado"] = estado_esperado
+        if "cambios" in df.columns:
+            # mascara de compare_rows: solo se tocan las entidades que cambiaron
+            for entidad in ["persona", "documento", "titular", "domicilio", "telefono"]:
+                stage[f"cambio_{entidad}"] = df[f"cambio_{entidad}"]
+            stage["cambio_plan"] = df["cambio_plan"]
+            stage["cambio_estado"] = ~df["cambio_plan"] & df["cambio_estado"]
+        else:
+            for entidad in ["persona", "documento", "titular", "domicilio", "telefono"]:
+                stage[f"cambio_{entidad}"] = True
+            stage["cambio_plan"] = cambio_plan
+            stage["cambio_estado"] = ~cambio_plan & (estado_esperado != df["estado_actual"])
+        return stage
+
+    def update_rows_bulk(self, df: pd.DataFrame, connection=None):
+        """
+        Set-based version of update_rows: the whole changed set is COPYed
+        into a session temp table and each core table is updated with a
+        single statement.
+        """
+        connection = connection or self.connection
+        cursor = connection.cursor()
+        self.logger.info(f"Updating {len(df)} rows")
+        hoy = str(datetime.datetime.now(BUENOS_AIRES_TZ).date())
+        try:
+            stage = self.build_update_stage(df)
+            self.copy_update_stage(cursor, stage)
+            self.apply_update_stage(cursor, hoy)
+
+            connection.commit()
+            self.logger.info(f"Updated {len(df)} afiliados.")
+            return True
 
         except Exception as e:
-            self.connection.rollback()
+            connection.rollback()
             self.logger.error("Failed to update afiliados", exc_info=True)
+            return False
         finally:
             cursor.close()
 
+    def copy_update_stage(self, cursor, stage: pd.DataFrame):
+        """COPYs a build_update_stage frame into the tmp_demi_update temp table."""
+        # La tabla temporal toma los tipos de las columnas de core
+        cursor.execute("""
+            CREATE TEMP TABLE tmp_demi_update ON COMMIT DROP AS
+            SELECT
+                afiliado.id AS id_afi,
+                persona.id AS id_persona,
+                persona.nombre,
+                persona.apellido,
+                persona.genero_biologico,
+                persona.fecha_nacimiento,
+                persona_documento.valor AS documento_valor,
+                persona_documento.id_param_documento_identificatorio,
+                afiliado.id_afiliado_titular,
+                domicilio.id AS id_domicilio,
+                domicilio.codigo_postal,
+                domicilio.calle,
+                domicilio.numeracion,
+                domicilio.piso,
+                domicilio.departamento,
+                domicilio.id_loc_localidad,
+                contacto.id AS id_contacto,
+                contacto.valor AS telefono,
+                afiliado_plan.id AS id_afiliado_plan,
+                afiliado_plan_estado.id AS id_estado_cierre,
+                afiliado_plan.id AS id_afiliado_plan_nuevo,
+                afiliado_plan.id_financiadora_plan AS id_financiadora_plan_nuevo,
+                afiliado_plan_estado.id AS id_estado_nuevo,
+                afiliado_plan_estado.estado AS estado_esperado,
+                TRUE AS cambio_persona,
+                TRUE AS cambio_documento,
+                TRUE AS cambio_titular,
+                TRUE AS cambio_domicilio,
+                TRUE AS cambio_telefono,
+                TRUE AS cambio_plan,
+                TRUE AS cambio_estado
+            FROM afiliado, persona, persona_documento, domicilio, contacto, afiliado_plan, afiliado_plan_estado
+            WITH NO DATA
+        """)
+        # los float enteros (por los NaN) tienen que viajar como enteros
+        for columna in stage.select_dtypes(include="float").columns:
+            valores = stage[columna].dropna()
+            if (valores == valores.round()).all():
+                stage[columna] = stage[columna].astype("Int64")
+        buffer = io.StringIO()
+        stage.to_csv(buffer, index=False, header=False, na_rep="\\N")
+        buffer.seek(0)
+        cursor.copy_expert(
+            "COPY tmp_demi_update FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+        )
 
-
+    def apply_update_stage(self, cursor, hoy: str):
+        """Updates every core table from tmp_demi_update, one statement per table."""
+        cursor.execute("""
+            UPDATE persona
+            SET nombre = s.nombre,
+                apellido = s.apellido,
+                genero_biologico = s.genero_biologico,
+                fecha_nacimiento = s.fecha_nacimiento
+            FROM tmp_demi_update s
+            WHERE persona.id = s.id_persona
+            AND s.cambio_persona
+        """)
+        cursor.execute("""
+            UPDATE persona_documento
+            SET valor = s.documento_valor,
+                id_param_documento_identificatorio = s.id_param_documento_identificatorio
+            FROM tmp_demi_update s
+            WHERE persona_documento.id_persona = s.id_persona
+            AND s.cambio_documento
+        """)
+        cursor.execute("""
+            UPDATE afiliado
+            SET id_afiliado_titular = s.id_afiliado_titular
+            FROM tmp_demi_update s
+            WHERE afiliado.id = s.id_afi
+            AND s.cambio_titular
+            AND s.id_afiliado_titular IS NOT NULL
+        """)
+        cursor.execute("""
+            UPDATE domicilio
+            SET codigo_postal = s.codigo_postal,
+                calle = s.calle,
+                numeracion = s.numeracion,
+                piso = s.piso,
+                departamento = s.departamento,
+                descripcion = '',
+                id_loc_localidad = s.id_loc_localidad
+            FROM tmp_demi_update s
+            WHERE domicilio.id = s.id_domicilio
+            AND s.cambio_domicilio
+        """)
+        cursor.execute("""
+            UPDATE contacto
+            SET valor = s.telefono
+            FROM tmp_demi_update s
+            WHERE contacto.id = s.id_contacto
+            AND s.cambio_telefono
+        """)
+        ########################################################################################################
+        # plan nuevo: se cierra el plan anterior y se crea el plan con su estado
+        cursor.execute("""
+            INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
+            SELECT id_estado_cierre, id_afiliado_plan, 'INACTIVO', %s
+            FROM tmp_demi_update
+            WHERE cambio_plan AND id_afiliado_plan IS NOT NULL
+        """, (hoy,))
+        cursor.execute("""
+            INSERT INTO afiliado_plan (id, id_afiliado, id_financiadora_plan)
+            SELECT id_afiliado_plan_nuevo, id_afi, id_financiadora_plan_nuevo
+            FROM tmp_demi_update
+            WHERE cambio_plan
+        """)
+        cursor.execute("""
+            INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
+            SELECT id_estado_nuevo, id_afiliado_plan_nuevo, estado_esperado, %s
+            FROM tmp_demi_update
+            WHERE cambio_plan
+        """, (hoy,))
+        # mismo plan con otro estado
+        cursor.execute("""
+            INSERT INTO afiliado_plan_estado (id, id_afiliado_plan, estado, fecha_desde)
+            SELECT id_estado_nuevo, id_afiliado_plan, estado_esperado, %s
+            FROM tmp_demi_update
+            WHERE cambio_estado
+        """, (hoy,))
+        if self.plan_state:
+            plan_state.refresh_from_update_stage(cursor)
+
+    @measured
     def standarize_data(self, df: pd.DataFrame):
-        DEMI_PLAN_LIST = {
-            "AZUL PLUS-VOL-ROS": "b60f55eb-c083-416e-a7fa-70657ba4ab81",
-            "AZUL PLUS-OBL-ROS": "b60f55eb-c083-416e-a7fa-70657ba4ab81",
-            "AZUL PLUS- OBLIG-SM": "b60f55eb-c083-416e-a7fa-70657ba4ab81",
-            "AZUL-COSEGURO A CARGO SOCIO 20,00%":"8c86723a-f71a-4eae-8e79-650fe88a6504",
-            "DEMI OP - OBLIG- SM": "a9064b7f-d422-4eac-9eec-e8946f7990aa",
-            "DEMI OP - OBLIG- ROS": "a9064b7f-d422-4eac-9eec-e8946f7990aa",
-            "DEMI OP - VOL- SM": "a9064b7f-d422-4eac-9eec-e8946f7990aa",
-            "DEMI-COSEGURO (SOLO PRACTICAS) 30%\xa0A\xa0CARGO\xa0SOCIO": "e485fb3a-df3f-430a-8389-32cf3f83a783",
-            "VITALICIO": "e0c71154-a805-49e2-bc8b-253be83cf179",
-            "VERDE - OBLIGATORIO": "7aec8bd7-22cf-42e0-84a9-2d0e6637a388",
-            "PLAN BASICO" : "5f322351-b6a9-4976-902a-a05f75779944",
-            "DS 1000": "a1896f07-e202-4c89-be5e-24de5b174014"
-
-        }
-
-        DEMI_DOCUMENTO_MAP = {
-            "DNI": 1,
-            "LE": 7,
-            "LC": 8,
-        }
-
         gender_map = {"M": "MASCULINO", "F": "FEMENINO", "U": "INTERSEXUAL"}
-        df[["APELLIDO", "NOMBRE"]] = df["APELLIDO_NOMBRE"].str.split(" ", n=1, expand=True)
-        df["TIPO_DOCUMENTO"] = df["TIPO_DOCUMENTO"].map(DEMI_DOCUMENTO_MAP)
-        df["NOMBRE_PLAN_NEW"] = df["NOMBRE_PLAN"].map(DEMI_PLAN_LIST)
+        df = df.copy()
+        nombres = map_unique(df["APELLIDO_NOMBRE"], lambda x: tuple(str(x).split(" ", 1)) if isinstance(x, str) else (x,))
+        df["APELLIDO"] = nombres.str[0]
+        df["NOMBRE"] = nombres.str[1]
+        df["TIPO_DOCUMENTO"] = df["TIPO_DOCUMENTO"].map(self.profile.documento_map)
+        df["NOMBRE_PLAN_NEW"] = df["NOMBRE_PLAN"].map(self.profile.plan_map)
         df["SEXO"] = df["SEXO"].map(gender_map)
         df["FECHA_NACIMIENTO"] = pd.to_datetime(
             df["FECHA_NACIMIENTO"], format="%d-%m-%Y", errors="coerce"
         )
         df["NUMEROTARJETA"] = df["NUMEROTARJETA"].astype(int).astype(str)
-        df["ID_TITULAR"] = df.apply(
-                lambda row: row["ID_AFILIADO"] if pd.isna(row["ID_TITULAR"]) else row["ID_TITULAR"],
-                axis=1
-            )
-        df["id_loc_estado"] = df["PROVINCIA"].apply(
-            lambda x: unidecode(str(x)).lower()
-        )
-
-        state_names = list(df["id_loc_estado"].unique())
-
-        state_names = [unidecode(x.lower()) for x in state_names]
+        df["ID_TITULAR"] = df["ID_TITULAR"].fillna(df["ID_AFILIADO"])
 
         state_mapping = {
             "cordoba": "Córdoba",
@@ -662,25 +1215,13 @@ class ScriptDemi:
             "santa fe": "Santa Fe",
         }
 
-        state_names = [state_mapping.get(x, x) for x in state_names]
-
-        state_ids = {}
-
-        cursor = self.connection.cursor()
-        for state_name in state_names:
-            cursor.execute(
-                "SELECT id FROM loc_estado WHERE LOWER(nombre) LIKE %s", (state_name.lower(),)
+        if self.gazetteer is None:
+            self.gazetteer = Gazetteer(self.connection, os.path.join(settings.STATE_DIR, "gazetteer.pkl"))
+        provincias = map_unique(df["PROVINCIA"], lambda x: unidecode(str(x)).lower())
+        with self.stage("geo"):
+            df["id_loc_estado"] = self.gazetteer.resolve_estados(
+                map_unique(provincias, lambda x: state_mapping.get(x, x))
             )
-            result = cursor.fetchone()
-            if result:
-                state_ids[state_name] = result[0]
-            else:
-                state_ids[state_name] = None
-        cursor.close()
-
-        df["id_loc_estado"] = (
-            df["id_loc_estado"].map(state_mapping).map(state_ids)
-        )
         city_replacements = {
             "CAP.": "CAPITAN ",
             "SJ.": "SAN JOSE ",
@@ -696,63 +1237,66 @@ class ScriptDemi:
             "CABA": "CIUDAD DE BUENOS AIRES",
         }
 
-        df["id_loc_localidad"] = df["LOCALIDAD"].replace(
-            city_replacements, regex=True
-        )
-
-        unique_cities = set(
-            zip(df["id_loc_localidad"], df["id_loc_estado"])
-        )
-
-        city_ids = {}
-        cursor = self.connection.cursor()
-        for city_name, state_name in unique_cities:
+        # los reemplazos por regex se corren una vez por localidad distinta
+        codes, localidades = pd.factorize(df["LOCALIDAD"], use_na_sentinel=False)
+        localidades = pd.Series(localidades, dtype=object).replace(city_replacements, regex=True)
+        df["id_loc_localidad"] = localidades.to_numpy()[codes]
 
-            cursor.execute(
-                f"SELECT id FROM loc_localidad WHERE LOWER(nombre) LIKE '{city_name.lower()}' AND id_loc_estado = '{state_name}' AND id_financiadora IS NULL"
+        with self.stage("geo"):
+            df["id_loc_localidad"] = self.gazetteer.resolve_localidades(
+                df["id_loc_localidad"], df["id_loc_estado"]
             )
-            result = cursor.fetchone()
-            if result:
-                city_ids[city_name] = result[0]
-            else:
-                city_ids[city_name] = None
-        cursor.close()
-        df["id_loc_localidad"] = df["id_loc_localidad"].map(city_ids)
         df["CODIGO_POSTAL"] = df["CODIGO_POSTAL"].astype(str)
         df.drop(columns=["id_loc_estado"], inplace=True)
+        # las columnas category / Int64 del schema no aceptan "" como valor
+        df = df.astype({c: object for c, dtype in df.dtypes.items() if isinstance(dtype, pd.api.extensions.ExtensionDtype)})
         df.fillna("", inplace=True) # Reemplazados NaN con String vacío para Front CD Flutter
         return df
 
+    @measured
     def compare_rows(self, comparison_df):
         # Crear columna de estado esperado basado en MOROSO
-        comparison_df["estado_esperado"] = comparison_df["MOROSO"].apply(
-            lambda x: "ACTIVO" if x == "NO" else "MOROSO"
-        )
-
-        column_comparisons = (
-            (comparison_df["NOMBRE"] != comparison_df["nombre"])
-            | (comparison_df["APELLIDO"] != comparison_df["apellido"])
-            | (
-                comparison_df["TIPO_DOCUMENTO"]
-                != comparison_df["id_param_documento_identificatorio"]
-            )
-            | (comparison_df["NUMERODOCUMENTO"].astype(str) != comparison_df["n_documento"])
-            | (comparison_df["FECHA_NACIMIENTO"] != comparison_df["fecha_nacimiento"])
-            | (comparison_df["TITULAR_TARJETA"] != comparison_df["codigo_titular"])
-            | (comparison_df["NOMBRE_PLAN_NEW"] != comparison_df["id_financiadora_plan"])
-            | (comparison_df["estado_esperado"] != comparison_df["estado_actual"])
-            | (comparison_df["CODIGO_POSTAL"] != comparison_df["codigo_postal"])
-            | (comparison_df["CALLE"] != comparison_df["calle"])
-            | (comparison_df["NUMERO"] != comparison_df["numeracion"])
-            | (comparison_df["PISO"] != comparison_df["piso"])
-            | (comparison_df["DEPARTAMENTO"] != comparison_df["departamento"])
-            | (comparison_df["TELEFONO"] != comparison_df["telefono"])
+        comparison_df["estado_esperado"] = np.where(comparison_df["MOROSO"] == "NO", "ACTIVO", "MOROSO")
+
+        # se compara el texto normalizado de cada lado, asi 1.0 == "1" y Timestamp == date
+        def differs(new, old):
+            return map_unique(comparison_df[new], como_texto) != map_unique(comparison_df[old], como_texto)
+
+        cambios = {
+            "persona": (
+                differs("NOMBRE", "nombre")
+                | differs("APELLIDO", "apellido")
+                | differs("SEXO", "genero_biologico")
+                | differs("FECHA_NACIMIENTO", "fecha_nacimiento")
+            ),
+            "documento": (
+                differs("TIPO_DOCUMENTO", "id_param_documento_identificatorio")
+                | differs("NUMERODOCUMENTO", "n_documento")
+            ),
+            "titular": differs("TITULAR_TARJETA", "codigo_titular"),
+            "plan": differs("NOMBRE_PLAN_NEW", "id_financiadora_plan"),
+            "estado": differs("estado_esperado", "estado_actual"),
+            "domicilio": (
+                differs("CODIGO_POSTAL", "codigo_postal")
+                | differs("CALLE", "calle")
+                | differs("NUMERO", "numeracion")
+                | differs("PISO", "piso")
+                | differs("DEPARTAMENTO", "departamento")
+            ),
+            "telefono": differs("TELEFONO", "telefono"),
+        }
 
-        )
+        bitmap = np.zeros(len(comparison_df), dtype="int64")
+        for entidad, mask in cambios.items():
+            comparison_df[f"cambio_{entidad}"] = mask.to_numpy()
+            bitmap |= mask.to_numpy().astype("int64") * CAMBIOS[entidad]
+        comparison_df["cambios"] = bitmap
 
-        afis_to_update = comparison_df[column_comparisons]["codigo"].astype(str)
+        afis_to_update = comparison_df[bitmap != 0]["codigo"].astype(str)
         afis_to_update = afis_to_update.drop_duplicates().tolist()
-        print("Afis to update:", len(afis_to_update))
+        self.logger.info(f"Afis to update: {len(afis_to_update)}")
+        for entidad, mask in cambios.items():
+            self.logger.info(f"  {entidad}: {int(mask.sum())}")
 
         return afis_to_update
 
@@ -772,29 +1316,412 @@ class ScriptDemi:
 
         return data_new, data_old
 
-    def compare_data(self, old_data, new_data):
+    def write_batches(self, writer, df: pd.DataFrame, connection=None) -> bool:
+        """
+        Batch commit mode: writes df in batch_size slices, one transaction
+        each, and journals the NUMEROTARJETA committed by every slice. A bulk
+        slice that fails is retried row by row with savepoints. Rows that
+        could not be written end up in self.fallidos instead of failing the
+        call.
+        """
+        df = titulares_primero(df)
+        progress = self.progress(f"{writer.__name__} (batches)", len(df))
+        for start in range(0, len(df), self.batch_size):
+            batch = df.iloc[start:start + self.batch_size]
+            escrito = writer(batch, connection=connection)
+            bulk = self.bulk if writer == self.insert_missing_afiliados else self.bulk_update
+            if not escrito and bulk:
+                self.logger.warning(f"Bulk batch {start}-{start + len(batch)} failed, retrying row by row")
+                escrito = writer(batch, connection=connection, bulk=False)
+            if not escrito:
+                self.fallidos.extend(batch["NUMEROTARJETA"].astype("int64").tolist())
+                progress.advance(len(batch), errors=len(batch))
+                continue
+            codigos = batch["NUMEROTARJETA"].astype("int64")
+            commiteados = codigos[~codigos.isin(self.fallidos)]
+            self.checkpoint.record(writer.__name__, commiteados)
+            progress.advance(len(batch), errors=len(batch) - len(commiteados))
+        progress.finish()
+        return True
+
+    def write(self, writer, df: pd.DataFrame, connection=None) -> bool:
+        if self.batch_commit:
+            return self.write_batches(writer, df, connection)
+        if writer(df, connection=connection):
+            return True
+        # la transaccion entera se deshizo: ninguna fila quedo escrita
+        self.fallidos.extend(df["NUMEROTARJETA"].astype("int64").tolist())
+        return False
+
+    def write_sharded(self, writer, df: pd.DataFrame) -> bool:
+        """
+        Splits df by family group (titular + dependents) into `workers` shards
+        and runs writer on each one in its own thread, with its own pooled
+        connection and transaction. Without a pool it just calls writer.
+        Shards commit independently: the rows of a failed shard end up in
+        self.fallidos, the committed ones do not.
+        """
+        if self.changeset is not None:
+            return self.plan(writer, df)
+        if self.pool is None or self.workers <= 1 or len(df) == 0:
+            return self.write(writer, df)
+
+        # familia = titular resuelto, o el propio afiliado si no tiene
+        familia = df["id_afiliado_titular_nuevo"].replace("", np.nan)
+        for columna in ("id_afi_nuevo", "id_afi"):
+            if columna in df.columns:
+                familia = familia.fillna(df[columna].replace("", np.nan))
+        shard = pd.util.hash_array(familia.astype(str).to_numpy()) % self.workers
+
+        def run_shard(shard_df):
+            connection = self.pool.getconn()
+            try:
+                return self.write(writer, shard_df, self.metrics.wrap(connection) if self.metrics else connection)
+            finally:
+                self.pool.putconn(connection)
+
+        shards = [df[shard == n] for n in range(self.workers)]
+        shards = [shard_df for shard_df in shards if len(shard_df) > 0]
+        self.logger.info(f"Writing {len(df)} rows in {len(shards)} shards")
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(run_shard, shards))
+        return all(results)
+
+    def plan(self, writer, df: pd.DataFrame) -> bool:
+        """Plan mode: adds what writer would write to self.changeset instead of writing it."""
+        if len(df) == 0:
+            return True
+        if writer == self.deactivate_afiliados:
+            self.changeset.add_updates(self.removal_stage(df))
+        elif writer == self.insert_missing_afiliados:
+            df = titulares_primero(df)
+            # lo mismo que fillna(""), sin el downcast implicito que pandas depreca
+            df = df.astype(object).where(df.notna(), "")
+            for start in range(0, len(df), self.batch_size):
+                # fecha_desde se completa al aplicar
+                self.changeset.add_inserts(self.build_insert_batch(df.iloc[start:start + self.batch_size], None))
+        else:
+            self.changeset.add_updates(self.build_update_stage(df))
+        self.logger.info(f"Planned {len(df)} rows for {writer.__name__}")
+        return True
 
-        # encontrar los afis que faltan
-        # estos hay que cargarlos de 0
-        missing_afis = new_data[~new_data["NUMEROTARJETA"].astype(str).isin(old_data["codigo"])] # Se convierte a string para que coincida con el tipo de datos de old_data
+    @measured
+    def apply_changeset(self, changeset: Changeset) -> bool:
+        """
+        Writes a planned changeset in a single transaction: one COPY per
+        insert table in FK order, then the set-based updates of
+        update_rows_bulk. Refuses changesets already applied or whose new
+        afiliados already exist in core.
+        """
+        if changeset.manifest.get("applied_at"):
+            self.logger.error(f"Changeset {changeset.path} was already applied at {changeset.manifest['applied_at']}")
+            return False
+        connection = self.connection
+        cursor = connection.cursor()
+        hoy = str(datetime.datetime.now(BUENOS_AIRES_TZ).date())
+        try:
+            inserts = dict(changeset.insert_frames())
+            if "afiliado" in inserts:
+                cursor.execute("""
+                    SELECT count(*)
+                    FROM afiliado
+                    WHERE id_financiadora = %s
+                    AND codigo = ANY(%s)
+                """, (self.profile.id_financiadora, inserts["afiliado"]["codigo"].tolist()))
+                existentes = cursor.fetchone()[0]
+                if existentes:
+                    self.logger.error(f"Changeset {changeset.path} is stale: {existentes} of its new afiliados are already in core")
+                    return False
+
+            for tabla, frame in inserts.items():
+                if tabla == "afiliado_plan_estado":
+                    frame = frame.assign(fecha_desde=hoy)
+                buffer = io.StringIO()
+                frame.to_csv(buffer, index=False, header=False, na_rep="\\N")
+                buffer.seek(0)
+                cursor.copy_expert(
+                    f"COPY {tabla} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+                )
+                self.logger.info(f"Inserted {len(frame)} rows into {tabla}")
+            if self.plan_state and "afiliado" in inserts:
+                plan_state.refresh_afiliados(cursor, inserts["afiliado"]["id"].tolist())
 
-        if len (missing_afis) >0:
-            print("missing afis, starting loading")
-            missing_afis_standard = self.standarize_data(df=missing_afis)
-            self.insert_missing_afiliados(missing_afis_standard)
-            print("loading complete")
-        # los que estan, hay que ver si tienen data vieja en algun lado
-        existing_afis = new_data[
-            new_data["NUMEROTARJETA"].isin(old_data["codigo"].astype(int))
-        ]
-        existing_afis_standard = self.standarize_data(df=existing_afis)
-        existing_afis_standard, old_data = self.add_titular_data(
-            old_data, existing_afis_standard
+            stage = changeset.update_frame()
+            if len(stage):
+                self.copy_update_stage(cursor, stage)
+                self.apply_update_stage(cursor, hoy)
+                self.logger.info(f"Updated {len(stage)} afiliados")
+
+            connection.commit()
+            changeset.mark_applied()
+            self.logger.info(f"Applied changeset {changeset.path}.")
+            return True
+
+        except Exception as e:
+            connection.rollback()
+            self.logger.error(f"Failed to apply changeset {changeset.path}", exc_info=True)
+            return False
+        finally:
+            cursor.close()
+
+    @measured
+    def classify(self, old_data: pd.DataFrame, new_data: pd.DataFrame) -> tuple[pd.Series, pd.DataFrame]:
+        """
+        Joins feed and core once on NUMEROTARJETA / codigo as int64. Returns
+        the mask of feed rows already in core (the rest are new) and the
+        core rows missing from the feed.
+        """
+        codigo = old_data["codigo"].astype(str).str.strip()
+        numerico = codigo.str.fullmatch(r"\d+")
+        if not numerico.all():
+            self.logger.warning(f"{int((~numerico).sum())} core codigos are not numeric, they never match the feed")
+        claves = pd.DataFrame({
+            "clave": new_data["NUMEROTARJETA"].astype("int64").to_numpy(),
+            "fila_feed": np.arange(len(new_data)),
+        }).merge(
+            pd.DataFrame({
+                "clave": codigo[numerico].astype("int64").to_numpy(),
+                "fila_core": np.flatnonzero(numerico.to_numpy()),
+            }),
+            on="clave",
+            how="outer",
+            indicator=True,
+        )
+        en_core = np.zeros(len(new_data), dtype=bool)
+        en_core[claves.loc[claves["_merge"] == "both", "fila_feed"].astype("int64").to_numpy()] = True
+        removidos = old_data.iloc[claves.loc[claves["_merge"] == "right_only", "fila_core"].astype("int64").to_numpy()]
+        self.logger.info(f"Afis new: {int((~en_core).sum())}, in core: {int(en_core.sum())}, missing from the feed: {len(removidos)}")
+        return pd.Series(en_core, index=new_data.index), removidos
+
+    def retire_missing(self, old_data: pd.DataFrame, removidos: pd.DataFrame) -> bool:
+        """
+        Moves the current plan of afiliados missing from the feed to
+        INACTIVO, unless they are too many to be real drop-outs. False if
+        the deactivation was skipped or failed.
+        """
+        activos = old_data["estado_actual"] != "INACTIVO"
+        removidos = removidos[(removidos["estado_actual"] != "INACTIVO") & removidos["id_afiliado_plan"].notna()]
+        if len(removidos) == 0:
+            return True
+        limite = self.missing_max_fraction * int(activos.sum())
+        if len(removidos) > limite:
+            self.logger.error(
+                f"{len(removidos)} of {int(activos.sum())} active afiliados are missing from the feed "
+                f"(limit {limite:.0f}), skipping the deactivation"
+            )
+            return False
+        self.logger.info(f"Deactivating {len(removidos)} afis missing from the feed")
+        df = pd.DataFrame({
+            "NUMEROTARJETA": removidos["codigo"].astype("int64").to_numpy(),
+            "id_afi": removidos["id_afi"].to_numpy(),
+            "id_persona": removidos["id_persona"].to_numpy(),
+            "id_afiliado_plan": removidos["id_afiliado_plan"].to_numpy(),
+            # write_sharded agrupa por titular; cada baja va sola
+            "id_afiliado_titular_nuevo": "",
+        })
+        return self.write_sharded(self.deactivate_afiliados, df)
+
+    def removal_stage(self, df: pd.DataFrame) -> pd.DataFrame:
+        """tmp_demi_update rows that only add an INACTIVO estado to the current plan."""
+        n = len(df)
+        stage = pd.DataFrame(index=df.index)
+        stage["id_afi"] = df["id_afi"]
+        stage["id_persona"] = df["id_persona"]
+        for columna in [
+            "nombre", "apellido", "genero_biologico", "fecha_nacimiento", "documento_valor",
+            "id_param_documento_identificatorio", "id_afiliado_titular", "id_domicilio", "codigo_postal", "calle",
+            "numeracion", "piso", "departamento", "id_loc_localidad", "id_contacto", "telefono",
+        ]:
+            stage[columna] = None
+        stage["id_afiliado_plan"] = df["id_afiliado_plan"]
+        stage["id_estado_cierre"] = None
+        stage["id_afiliado_plan_nuevo"] = None
+        stage["id_financiadora_plan_nuevo"] = None
+        stage["id_estado_nuevo"] = [str(uuid4()) for _ in range(n)]
+        stage["estado_esperado"] = "INACTIVO"
+        for entidad in ["persona", "documento", "titular", "domicilio", "telefono", "plan"]:
+            stage[f"cambio_{entidad}"] = False
+        stage["cambio_estado"] = True
+        return stage
+
+    def deactivate_afiliados(self, df: pd.DataFrame, connection=None, bulk: bool | None = None):
+        """
+        Adds an INACTIVO estado to the current plan of every afiliado in df
+        through the update stage, so it is set-based like update_rows_bulk.
+        """
+        connection = connection or self.connection
+        cursor = connection.cursor()
+        hoy = str(datetime.datetime.now(BUENOS_AIRES_TZ).date())
+        try:
+            self.copy_update_stage(cursor, self.removal_stage(df))
+            self.apply_update_stage(cursor, hoy)
+            connection.commit()
+            self.logger.info(f"Deactivated {len(df)} afiliados.")
+            return True
+        except Exception:
+            connection.rollback()
+            self.logger.error("Failed to deactivate afiliados", exc_info=True)
+            return False
+        finally:
+            cursor.close()
+
+    @measured
+    def validate(self, standard: pd.DataFrame, new_data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drops the standarized rows that fail a validation rule, writing the
+        raw feed rows and their reasons to the quarantine file. Rows pointing
+        to a rejected new titular are re-pointed like rows whose titular
+        failed to insert.
+        """
+        motivos = rejection_reasons(standard)
+        rechazo = motivos != ""
+        if not rechazo.any():
+            return standard
+        self.logger.info(f"Afis quarantined: {int(rechazo.sum())}")
+        for motivo, cantidad in motivos[rechazo].str.split(",").explode().value_counts().items():
+            self.logger.info(f"  {motivo}: {cantidad}")
+        crudos = new_data.loc[rechazo[rechazo].index].drop(
+            columns=["TITULAR_TARJETA", "NOMBRE_TITULAR", "id_afi_nuevo", "id_afiliado_titular_nuevo"], errors="ignore"
         )
+        self.quarantine.write(crudos, motivos[rechazo])
+        self.rechazados.extend(standard.loc[rechazo, "NUMEROTARJETA"].astype("int64").tolist())
+
+        sin_insertar = standard.loc[rechazo, "id_afi_nuevo"]
+        sin_insertar = sin_insertar[sin_insertar != ""]
+        standard = standard[~rechazo]
+        if len(sin_insertar) > 0:
+            standard = standard.copy()
+            sin_titular = standard["id_afiliado_titular_nuevo"].isin(sin_insertar)
+            # los nuevos pasan a ser su propio titular, los existentes conservan el que tienen
+            nuevos = sin_titular & (standard["id_afi_nuevo"] != "")
+            standard.loc[nuevos, "id_afiliado_titular_nuevo"] = standard.loc[nuevos, "id_afi_nuevo"]
+            standard.loc[sin_titular & ~nuevos, "id_afiliado_titular_nuevo"] = ""
+            if self.feed_previo is not None:
+                self.feed_previo.loc[self.feed_previo["id_afi"].isin(sin_insertar), "id_afi"] = np.nan
+        return standard
+
+    def resolve_titulares(self, old_data: pd.DataFrame, new_data: pd.DataFrame, en_core: pd.Series):
+        """
+        Maps ID_TITULAR -> NUMEROTARJETA -> afiliado.id for the whole feed in
+        one pass. Afiliados not in core yet get their id pre-assigned, so a
+        titular and its dependents can be written in the same batch.
+        """
+        feed = pd.DataFrame({
+            "ID_AFILIADO": new_data["ID_AFILIADO"],
+            "ID_TITULAR": new_data["ID_TITULAR"].fillna(new_data["ID_AFILIADO"]),
+            "NUMEROTARJETA": new_data["NUMEROTARJETA"].astype(int).astype(str),
+            "APELLIDO_NOMBRE": new_data["APELLIDO_NOMBRE"],
+        })
+        previo = self.feed_previo
+        if previo is not None and len(previo) > 0:
+            # en modo stream los titulares pueden haber llegado en chunks anteriores
+            todo, old_data = self.add_titular_data(old_data, pd.concat([previo.drop(columns="id_afi"), feed]))
+            feed = todo.iloc[len(previo):]
+        else:
+            feed, old_data = self.add_titular_data(old_data, feed)
+
+        nuevos = feed.loc[~en_core, "NUMEROTARJETA"]
+        id_afi_nuevo = pd.Series([str(uuid4()) for _ in range(len(nuevos))], index=nuevos.index, dtype=object)
+        ids = pd.concat([
+            pd.Series(old_data["id_afi"].to_numpy(), index=old_data["codigo"].astype(str)),
+            pd.Series(id_afi_nuevo.to_numpy(), index=nuevos.to_numpy()),
+        ])
+        if previo is not None:
+            ids = pd.concat([ids, pd.Series(previo["id_afi"].to_numpy(), index=previo["NUMEROTARJETA"].to_numpy())])
+        ids = ids[~ids.index.duplicated()]
+        if previo is not None:
+            feed = feed.assign(id_afi=feed["NUMEROTARJETA"].map(ids))
+            self.feed_previo = pd.concat([previo, feed[previo.columns]], ignore_index=True)
+
+        new_data = new_data.copy()
+        new_data["TITULAR_TARJETA"] = feed["TITULAR_TARJETA"]
+        new_data["NOMBRE_TITULAR"] = feed["NOMBRE_TITULAR"]
+        new_data["id_afi_nuevo"] = id_afi_nuevo
+        # los afis nuevos sin titular resoluble son su propio titular,
+        # los existentes sin titular resoluble conservan el que tienen
+        new_data["id_afiliado_titular_nuevo"] = feed["TITULAR_TARJETA"].map(ids).fillna(id_afi_nuevo)
+        return new_data, old_data
+
+    def compare_data(self, old_data, new_data) -> bool:
+        """
+        Inserts the afiliados missing from core, updates the changed ones and,
+        with deactivate_missing, retires the ones missing from the feed. False
+        if any write failed (the rows involved are in self.fallidos) or the
+        retirement was skipped.
+        """
+        ok = True
+        huellas = None
+        if self.fingerprints is not None:
+            # fingerprints de la fila cruda, antes de cualquier transformacion
+            huellas = self.fingerprints.hash_rows(new_data)
+            cambiados = self.fingerprints.changed(new_data["NUMEROTARJETA"], huellas)
+            if self.full_reconcile:
+                cambiados[:] = True
+
+        def registrar_huellas(mask):
+            if huellas is not None:
+                # los rechazados se vuelven a intentar en la proxima corrida
+                pendientes = self.fallidos + self.rechazados
+                # igual que los dependientes de esos titulares: validate y no_insertados les
+                # reescribieron el vinculo, que se rehace cuando el titular llegue a core
+                titular = pd.to_numeric(new_data["TITULAR_TARJETA"], errors="coerce")
+                mask = mask & ~new_data["NUMEROTARJETA"].isin(pendientes) & ~titular.isin(pendientes)
+                self.fingerprints.stage(new_data.loc[mask, "NUMEROTARJETA"], huellas[mask])
+
+        # los que no estan en core hay que cargarlos de 0, los que estan hay que ver
+        # si tienen data vieja en algun lado, y los de core que ya no vienen se dan de baja
+        en_core, removidos = self.classify(old_data, new_data)
+        existentes = en_core.copy()
+        if self.deactivate_missing and self.feed_previo is None:
+            # en modo stream se hace en sync_streaming, con el feed completo
+            ok &= self.retire_missing(old_data, removidos)
+        new_data, old_data = self.resolve_titulares(old_data, new_data, en_core)
+        if huellas is not None:
+            self.logger.info(f"Afis unchanged since last run: {(existentes & ~cambiados).sum()}")
+            existentes &= cambiados
+
+        # se estandariza una sola vez todo lo que hay que procesar y despues se separa
+        procesar = ~en_core | existentes
+        if self.checkpoint is not None:
+            # reanudacion: lo ya commiteado en una corrida interrumpida no se reescribe
+            hechos = new_data["NUMEROTARJETA"].isin(self.checkpoint.done)
+            if hechos.any():
+                self.logger.info(f"Afis already committed by a previous attempt: {hechos.sum()}")
+                if self.checkpoint.identifies_feed:
+                    # con otro feed lo commiteado no es esta fila: sin huella se revisa la proxima vez
+                    registrar_huellas(hechos)
+                procesar &= ~hechos
+        if not procesar.any():
+            return ok
+        standard = self.standarize_data(df=new_data[procesar])
+        if self.quarantine is not None:
+            standard = self.validate(standard, new_data)
+        missing_afis_standard = standard[~en_core.loc[standard.index]]
+        existing_afis_standard = standard[existentes.loc[standard.index]]
+
+        if len(missing_afis_standard) > 0:
+            self.logger.info("missing afis, starting loading")
+            ok &= self.write_sharded(self.insert_missing_afiliados, missing_afis_standard)
+            self.logger.info("loading complete")
+        # lo que no se pudo escribir (shard, lote o fila) esta en self.fallidos
+        registrar_huellas(~en_core)
+        if len(existing_afis_standard) == 0:
+            return ok
+        no_insertados = missing_afis_standard["id_afi_nuevo"]
+        no_insertados = no_insertados[missing_afis_standard["NUMEROTARJETA"].astype("int64").isin(self.fallidos)]
+        if len(no_insertados) > 0:
+            # no apuntar a titulares que no llegaron a insertarse
+            existing_afis_standard = existing_afis_standard.copy()
+            sin_titular = existing_afis_standard["id_afiliado_titular_nuevo"].isin(no_insertados)
+            existing_afis_standard.loc[sin_titular, "id_afiliado_titular_nuevo"] = ""
+            if self.feed_previo is not None:
+                sin_titular = self.feed_previo["id_afi"].isin(no_insertados)
+                self.feed_previo.loc[sin_titular, "id_afi"] = np.nan
         # Asegurar que los datos viejos también tengan strings vacíos en lugar de NaN/None
 
-        comparison_df = existing_afis_standard.merge(
-            old_data,
+        # solo las columnas que se comparan o se escriben, para no duplicar ambos frames enteros
+        comparison_df = existing_afis_standard[FEED_COMPARE_COLUMNS].merge(
+            old_data[CORE_COMPARE_COLUMNS],
             left_on="NUMEROTARJETA",
             right_on="codigo",
             how="left",
@@ -803,4 +1730,6 @@ class ScriptDemi:
         afis_to_update = self.compare_rows(comparison_df)
         comparison_df["codigo"] = comparison_df["codigo"].astype(str)
         update_data =comparison_df[comparison_df["codigo"].isin(afis_to_update)]
-        self.update_rows(update_data)
+        ok &= self.write_sharded(self.update_rows, update_data)
+        registrar_huellas(existentes)
+        return ok
@@ -0,0 +1,78 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["FingerprintStore"]
+
+
+class FingerprintStore:
+    """
+    NUMEROTARJETA -> hash of the normalized source row, as of the last
+    successful run. Stored as two sorted numpy arrays in a .npz file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self.previous = self.load()
+        self.staged = []
+        self.seen = []
+
+    def load(self) -> pd.Series:
+        if not os.path.exists(self.path):
+            self.logger.info("No fingerprint store found, every row counts as changed.")
+            return pd.Series(dtype="uint64", index=pd.Index([], dtype="int64"))
+        with np.load(self.path) as store:
+            return pd.Series(store["hash"], index=store["codigo"])
+
+    @staticmethod
+    def hash_rows(df: pd.DataFrame) -> pd.Series:
+        """
+        Hashes every feed row. Columns are taken in name order and rendered
+        as stripped text, so dtype inference differences between runs (1 vs
+        1.0, NaN vs "") do not change the fingerprint.
+        """
+        normalized = {}
+        for column in sorted(df.columns):
+            col = df[column]
+            if pd.api.types.is_float_dtype(col):
+                valores = col.dropna()
+                if (valores == valores.round()).all():
+                    col = col.astype("Int64")
+            texto = col.astype(str).str.strip()
+            normalized[column] = texto.where(col.notna(), "")
+        return pd.util.hash_pandas_object(pd.DataFrame(normalized), index=False)
+
+    def changed(self, codigos: pd.Series, hashes: pd.Series) -> pd.Series:
+        """Boolean mask, aligned with codigos, of rows new or changed since the last run."""
+        codigos = codigos.astype("int64")
+        self.seen.append(codigos.to_numpy())
+        # 0 marca "sin fingerprint previo" sin pasar los hashes uint64 a float
+        previous = self.previous.reindex(codigos.to_numpy(), fill_value=0).to_numpy()
+        return pd.Series((previous == 0) | (previous != hashes.to_numpy()), index=codigos.index)
+
+    def stage(self, codigos: pd.Series, hashes: pd.Series):
+        """Records fingerprints of rows that were written successfully."""
+        self.staged.append(pd.Series(hashes.to_numpy(), index=codigos.astype("int64").to_numpy()))
+
+    def save(self, path: str | None = None):
+        """
+        Writes the store for the next run: previous fingerprints of afiliados
+        still in the feed, overridden by the ones staged in this run. `path`
+        defaults to the store's own file.
+        """
+        path = path or self.path
+        seen = np.unique(np.concatenate(self.seen)) if self.seen else np.array([], dtype="int64")
+        store = self.previous[self.previous.index.isin(seen)]
+        if self.staged:
+            store = pd.concat([store] + self.staged)
+            store = store[~store.index.duplicated(keep="last")]
+        store = store.sort_index()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, codigo=store.index.to_numpy(dtype="int64"), hash=store.to_numpy(dtype="uint64"))
+        os.replace(tmp_path, path)
+        self.logger.info(f"Saved {len(store)} fingerprints to {path}")
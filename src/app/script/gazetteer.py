@@ -0,0 +1,115 @@
+import logging
+import os
+import threading
+
+import pandas as pd
+import psycopg2
+from unidecode import unidecode
+
+__all__ = ["Gazetteer", "normalize_name"]
+
+
+def normalize_name(value) -> str:
+    return " ".join(unidecode(str(value)).lower().split())
+
+
+def normalize_column(col: pd.Series) -> pd.Series:
+    # una normalizacion por valor distinto
+    codes, uniques = pd.factorize(col, use_na_sentinel=False)
+    normalized = pd.Index([normalize_name(x) if isinstance(x, str) else None for x in uniques], dtype=object)
+    return pd.Series(normalized.take(codes), index=col.index)
+
+
+class Gazetteer:
+    """
+    In-memory index of loc_estado / loc_localidad keyed by normalized name,
+    persisted to a local pickle and reloaded only when the row count or a
+    hash of the ids and names of either table changes. One instance can be shared by scripts
+    running in several threads.
+    """
+
+    def __init__(self, connection: psycopg2.extensions.connection, cache_path: str):
+        self.connection = connection
+        self.cache_path = cache_path
+        self.logger = logging.getLogger(__name__)
+        self.estados = None
+        self.localidades = None
+        self.lock = threading.Lock()
+
+    def signature(self) -> tuple:
+        cursor = self.connection.cursor()
+        # el hash incluye los nombres: un renombre tambien invalida el cache
+        cursor.execute("""
+            SELECT
+                (SELECT count(*) FROM loc_estado),
+                (SELECT md5(string_agg(id::text || ':' || coalesce(nombre, ''), ',' ORDER BY id)) FROM loc_estado),
+                (SELECT count(*) FROM loc_localidad WHERE id_financiadora IS NULL),
+                (
+                    SELECT md5(string_agg(
+                        id::text || ':' || coalesce(nombre, '') || ':' || coalesce(id_loc_estado::text, ''), ',' ORDER BY id
+                    ))
+                    FROM loc_localidad
+                    WHERE id_financiadora IS NULL
+                )
+        """)
+        firma = tuple(cursor.fetchone())
+        cursor.close()
+        return firma
+
+    def load(self):
+        with self.lock:
+            self.load_locked()
+
+    def load_locked(self):
+        if self.estados is not None:
+            return
+        try:
+            self.load_from_core()
+        finally:
+            # solo lecturas: se cierra la transaccion para no dejar la conexion idle in transaction
+            self.connection.rollback()
+
+    def load_from_core(self):
+        firma = self.signature()
+        if os.path.exists(self.cache_path):
+            cache = pd.read_pickle(self.cache_path)
+            if cache.get("firma") == firma:
+                self.logger.info("Gazetteer loaded from local cache.")
+                self.estados = cache["estados"]
+                self.localidades = cache["localidades"]
+                return
+
+        self.logger.info("Gazetteer cache missing or stale, loading loc_estado/loc_localidad...")
+        estados = pd.read_sql("SELECT id, nombre FROM loc_estado", con=self.connection)
+        localidades = pd.read_sql(
+            "SELECT id, nombre, id_loc_estado FROM loc_localidad WHERE id_financiadora IS NULL",
+            con=self.connection,
+        )
+        estados["nombre"] = normalize_column(estados["nombre"])
+        localidades["nombre"] = normalize_column(localidades["nombre"])
+        localidades["id_loc_estado"] = localidades["id_loc_estado"].astype(str)
+        self.estados = estados.drop_duplicates("nombre").set_index("nombre")["id"].astype(str)
+        self.localidades = localidades.dropna(subset=["nombre"]).drop_duplicates(["nombre", "id_loc_estado"])
+
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        pd.to_pickle(
+            {"firma": firma, "estados": self.estados, "localidades": self.localidades},
+            tmp_path,
+        )
+        os.replace(tmp_path, self.cache_path)
+
+    def resolve_estados(self, nombres: pd.Series) -> pd.Series:
+        """loc_estado.id for every state name, NaN when it is not found."""
+        self.load()
+        return normalize_column(nombres).map(self.estados)
+
+    def resolve_localidades(self, nombres: pd.Series, id_estados: pd.Series) -> pd.Series:
+        """loc_localidad.id for every (city name, loc_estado.id) pair, NaN when it is not found."""
+        self.load()
+        claves = pd.DataFrame({
+            "nombre": normalize_column(nombres).to_numpy(),
+            "id_loc_estado": id_estados.to_numpy(),
+        })
+        resueltas = claves.merge(self.localidades, how="left", on=["nombre", "id_loc_estado"])
+        return pd.Series(resueltas["id"].to_numpy(), index=nombres.index)
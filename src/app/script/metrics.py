@@ -0,0 +1,276 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+
+__all__ = ["Metrics", "CountingReader", "measured"]
+
+TABLE_PATTERN = re.compile(
+    r"^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|COPY|CREATE\s+TEMP\s+TABLE)\s+([\w.]+)"
+    r"|\bFROM\s+([\w.]+)",
+    re.IGNORECASE,
+)
+
+
+def table_of(query) -> str:
+    """Main table of a statement, or its first keyword (SAVEPOINT, ANALYZE...) when there is none."""
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    match = TABLE_PATTERN.search(query)
+    if match:
+        return (match.group(1) or match.group(2)).lower()
+    palabras = query.split(None, 1)
+    return palabras[0].upper() if palabras else ""
+
+
+def row_count(value) -> int:
+    if isinstance(value, (pd.DataFrame, pd.Series, list)):
+        return len(value)
+    return 0
+
+
+class Metrics:
+    """
+    Per-stage counters of one run: wall time, rows in/out, SQL statements,
+    rows affected and bytes, plus statements and rows per table. SQL is
+    attributed to the innermost stage running on the same thread.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.stages = {}
+        self.tables = {}
+        self.extra = {}
+
+    def current(self) -> str:
+        pila = getattr(self.local, "stages", None)
+        return pila[-1] if pila else "other"
+
+    def stage_counters(self, nombre: str) -> dict:
+        return self.stages.setdefault(nombre, {
+            "calls": 0,
+            "seconds": 0.0,
+            "rows_in": 0,
+            "rows_out": 0,
+            "sql_statements": 0,
+            "sql_rows": 0,
+            "bytes": 0,
+        })
+
+    @contextlib.contextmanager
+    def measure(self, nombre: str, rows_in: int = 0):
+        """Times the block as stage `nombre`; yields the counters so the caller can set rows_out."""
+        pila = self.local.__dict__.setdefault("stages", [])
+        pila.append(nombre)
+        salida = {"rows_out": 0}
+        inicio = time.perf_counter()
+        try:
+            yield salida
+        finally:
+            segundos = time.perf_counter() - inicio
+            pila.pop()
+            with self.lock:
+                contadores = self.stage_counters(nombre)
+                contadores["calls"] += 1
+                contadores["seconds"] += segundos
+                contadores["rows_in"] += rows_in
+                contadores["rows_out"] += salida["rows_out"]
+
+    def record_sql(self, query, rows: int, nbytes: int):
+        tabla = table_of(query)
+        with self.lock:
+            contadores = self.stage_counters(self.current())
+            contadores["sql_statements"] += 1
+            contadores["sql_rows"] += max(rows, 0)
+            contadores["bytes"] += nbytes
+            por_tabla = self.tables.setdefault(tabla, {"sql_statements": 0, "sql_rows": 0})
+            por_tabla["sql_statements"] += 1
+            por_tabla["sql_rows"] += max(rows, 0)
+
+    def record_bytes(self, nbytes: int, stage: str | None = None):
+        with self.lock:
+            self.stage_counters(stage or self.current())["bytes"] += nbytes
+
+    def wrap(self, connection):
+        return CountingConnection(connection, self)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "started_at": self.started,
+                "seconds": time.time() - self.started,
+                "stages": {nombre: dict(c) for nombre, c in self.stages.items()},
+                "tables": {tabla: dict(c) for tabla, c in self.tables.items()},
+                **self.extra,
+            }
+
+    def write_json(self, path: str):
+        write_atomic(path, json.dumps(self.summary(), indent=2))
+        self.logger.info(f"Metrics written to {path}")
+
+    def write_prometheus(self, path: str, labels: dict | None = None):
+        """Writes the summary in the node_exporter textfile format."""
+        resumen = self.summary()
+        base = "".join(f',{k}="{v}"' for k, v in (labels or {}).items())
+        lineas = []
+
+        def metrica(nombre, ayuda, valores):
+            lineas.append(f"# HELP {nombre} {ayuda}")
+            lineas.append(f"# TYPE {nombre} gauge")
+            for etiquetas, valor in valores:
+                etiquetas = (etiquetas + base).lstrip(",")
+                lineas.append(f"{nombre}{{{etiquetas}}} {valor}" if etiquetas else f"{nombre} {valor}")
+
+        for campo, ayuda in [
+            ("seconds", "Wall time spent in each sync stage."),
+            ("calls", "Times each sync stage ran."),
+            ("rows_in", "Rows handed to each sync stage."),
+            ("rows_out", "Rows produced or written by each sync stage."),
+            ("sql_statements", "SQL statements issued by each sync stage."),
+            ("sql_rows", "Rows affected or returned by the SQL of each sync stage."),
+            ("bytes", "Bytes moved by each sync stage: SQL text sent, COPY data and feed downloaded."),
+        ]:
+            metrica(
+                f"demi_stage_{campo}",
+                ayuda,
+                [(f'stage="{nombre}"', c[campo]) for nombre, c in sorted(resumen["stages"].items())],
+            )
+        metrica(
+            "demi_table_sql_statements",
+            "SQL statements issued per table.",
+            [(f'table="{t}"', c["sql_statements"]) for t, c in sorted(resumen["tables"].items())],
+        )
+        metrica(
+            "demi_table_sql_rows",
+            "Rows affected or returned per table.",
+            [(f'table="{t}"', c["sql_rows"]) for t, c in sorted(resumen["tables"].items())],
+        )
+        metrica("demi_run_seconds", "Wall time of the whole run.", [("", round(resumen["seconds"], 3))])
+        metrica("demi_run_last_timestamp_seconds", "When the run finished.", [("", round(time.time()))])
+        for nombre, valor in sorted(self.extra.items()):
+            metrica(f"demi_run_{nombre}", f"{nombre.replace('_', ' ').capitalize()} of the run.", [("", valor)])
+        write_atomic(path, "\n".join(lineas) + "\n")
+        self.logger.info(f"Prometheus metrics written to {path}")
+
+
+def write_atomic(path: str, content: str):
+    # node_exporter no tiene que ver nunca un archivo a medio escribir
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as archivo:
+        archivo.write(content)
+    os.replace(tmp_path, path)
+
+
+def measured(func):
+    """Records a ScriptDemi method as a stage of self.metrics, when the script has one."""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if self.metrics is None:
+            return func(self, *args, **kwargs)
+        entrada = args[0] if args else next(iter(kwargs.values()), None)
+        with self.metrics.measure(func.__name__, row_count(entrada)) as salida:
+            resultado = func(self, *args, **kwargs)
+            salida["rows_out"] = row_count(entrada) if resultado is True else row_count(resultado)
+            return resultado
+
+    return wrapper
+
+
+class CountingCursor:
+    """psycopg2 cursor proxy that reports every statement to a Metrics."""
+
+    def __init__(self, cursor, metrics: Metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    def execute(self, query, vars=None):
+        try:
+            return self._cursor.execute(query, vars)
+        finally:
+            self._metrics.record_sql(query, self._cursor.rowcount, len(self._cursor.query or b""))
+
+    def executemany(self, query, vars_list):
+        try:
+            return self._cursor.executemany(query, vars_list)
+        finally:
+            self._metrics.record_sql(query, self._cursor.rowcount, 0)
+
+    def copy_expert(self, sql, file, size=8192):
+        inicio = file.tell() if file.seekable() else 0
+        try:
+            return self._cursor.copy_expert(sql, file, size)
+        finally:
+            nbytes = file.tell() - inicio if file.seekable() else 0
+            self._metrics.record_sql(sql, self._cursor.rowcount, nbytes)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return self._cursor.__exit__(*exc)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection:
+    """psycopg2 connection proxy whose cursors are CountingCursors."""
+
+    def __init__(self, connection, metrics: Metrics):
+        self._connection = connection
+        self._metrics = metrics
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._connection.cursor(*args, **kwargs), self._metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._connection, name, value)
+
+
+class CountingReader:
+    """Binary file proxy that adds every byte read to a stage of a Metrics."""
+
+    def __init__(self, source, metrics: Metrics, stage: str):
+        self._source = source
+        self._metrics = metrics
+        self._stage = stage
+
+    def read(self, size=-1):
+        data = self._source.read(size)
+        self._metrics.record_bytes(len(data), self._stage)
+        return data
+
+    def read1(self, size=-1):
+        data = self._source.read1(size)
+        self._metrics.record_bytes(len(data), self._stage)
+        return data
+
+    def readinto(self, buffer):
+        nbytes = self._source.readinto(buffer)
+        self._metrics.record_bytes(nbytes or 0, self._stage)
+        return nbytes
+
+    def __iter__(self):
+        return iter(self._source)
+
+    def __getattr__(self, name):
+        return getattr(self._source, name)
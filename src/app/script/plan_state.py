@@ -0,0 +1,91 @@
+"""
+afiliado_plan_actual: one row per afiliado with its current plan and the
+current estado of that plan, scoped by financiadora. The writers refresh it
+in the same transaction that inserts afiliado_plan / afiliado_plan_estado
+rows, so load_old_data can read it with an indexed lookup instead of
+ranking the whole plan and estado history.
+"""
+import logging
+
+__all__ = ["DDL", "ensure_table", "refresh_afiliados", "refresh_from_update_stage", "backfill"]
+
+DDL = """
+CREATE TABLE IF NOT EXISTS afiliado_plan_actual (
+    id_afiliado uuid PRIMARY KEY REFERENCES afiliado (id),
+    id_financiadora uuid NOT NULL,
+    id_afiliado_plan uuid NOT NULL REFERENCES afiliado_plan (id),
+    id_financiadora_plan uuid,
+    estado text NOT NULL,
+    fecha_desde date,
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS afiliado_plan_actual_id_financiadora_idx ON afiliado_plan_actual (id_financiadora);
+"""
+
+# Mismo criterio que los ROW_NUMBER de load_old_data: ultimo plan por created_at,
+# ultimo estado de ese plan por fecha_desde, ACTIVO si el plan no tiene estados
+REFRESH = """
+INSERT INTO afiliado_plan_actual (id_afiliado, id_financiadora, id_afiliado_plan, id_financiadora_plan, estado, fecha_desde, updated_at)
+SELECT DISTINCT ON (afiliado.id)
+    afiliado.id,
+    afiliado.id_financiadora,
+    afiliado_plan.id,
+    afiliado_plan.id_financiadora_plan,
+    COALESCE(estado.estado, 'ACTIVO'),
+    estado.fecha_desde,
+    now()
+FROM afiliado
+JOIN afiliado_plan ON afiliado_plan.id_afiliado = afiliado.id
+LEFT JOIN LATERAL (
+    SELECT afiliado_plan_estado.estado, afiliado_plan_estado.fecha_desde
+    FROM afiliado_plan_estado
+    WHERE afiliado_plan_estado.id_afiliado_plan = afiliado_plan.id
+    ORDER BY afiliado_plan_estado.fecha_desde DESC
+    LIMIT 1
+) estado ON TRUE
+WHERE {filtro}
+ORDER BY afiliado.id, afiliado_plan.created_at DESC NULLS LAST
+ON CONFLICT (id_afiliado) DO UPDATE
+SET id_financiadora = EXCLUDED.id_financiadora,
+    id_afiliado_plan = EXCLUDED.id_afiliado_plan,
+    id_financiadora_plan = EXCLUDED.id_financiadora_plan,
+    estado = EXCLUDED.estado,
+    fecha_desde = EXCLUDED.fecha_desde,
+    updated_at = EXCLUDED.updated_at
+"""
+
+
+def ensure_table(cursor):
+    cursor.execute(DDL)
+
+
+def refresh_afiliados(cursor, ids_afiliado):
+    """Recomputes the current plan/estado of the given afiliado ids."""
+    ids_afiliado = [str(id_afiliado) for id_afiliado in ids_afiliado]
+    if ids_afiliado:
+        cursor.execute(REFRESH.format(filtro="afiliado.id = ANY(%s::uuid[])"), (ids_afiliado,))
+
+
+def refresh_from_update_stage(cursor):
+    """Recomputes the afiliados whose plan or estado changed in tmp_demi_update."""
+    cursor.execute(REFRESH.format(filtro="""afiliado.id IN (
+        SELECT id_afi FROM tmp_demi_update WHERE cambio_plan OR cambio_estado
+    )"""))
+
+
+def backfill(connection, id_financiadora: str):
+    """Creates the table if needed and (re)computes every afiliado of a financiadora, in one transaction."""
+    logger = logging.getLogger(__name__)
+    cursor = connection.cursor()
+    try:
+        ensure_table(cursor)
+        cursor.execute(REFRESH.format(filtro="afiliado.id_financiadora = %s"), (id_financiadora,))
+        filas = cursor.rowcount
+        connection.commit()
+        logger.info(f"Backfilled afiliado_plan_actual with {filas} afiliados of {id_financiadora}")
+        return filas
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
@@ -0,0 +1,56 @@
+"""
+Cheap "did the feed change?" check that runs before the data stack is
+imported or Postgres is touched. Only uses the standard library.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+from ftplib import FTP
+
+__all__ = ["feed_signature", "FeedState"]
+
+
+def feed_signature(profile, ftp: bool, timeout: float = 0) -> str:
+    """
+    Identity of the feed as it is now: SIZE and MDTM of the remote file, or
+    the sha256 of the local file.
+    """
+    if ftp:
+        from app.core.settings import settings
+
+        with FTP(profile.ftp_host or settings.BASE_FTP, timeout=timeout or None) as conexion:
+            conexion.login(user=profile.ftp_user or settings.FTP_USER, passwd=profile.ftp_password or settings.FTP_PASSW)
+            conexion.cwd(profile.ftp_dir)
+            conexion.voidcmd("TYPE I")
+            size = conexion.size(profile.feed_file)
+            mdtm = conexion.voidcmd(f"MDTM {profile.feed_file}").split(maxsplit=1)[1]
+        return f"ftp:{size}:{mdtm}"
+    digest = hashlib.sha256()
+    with open(profile.feed_file, "rb") as archivo:
+        for bloque in iter(lambda: archivo.read(1024 * 1024), b""):
+            digest.update(bloque)
+    return f"sha256:{digest.hexdigest()}"
+
+
+class FeedState:
+    """Signature of the last feed a profile synced successfully, kept in its state directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+
+    def last(self) -> str | None:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as archivo:
+            return json.load(archivo).get("signature")
+
+    def save(self, signature: str):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as archivo:
+            json.dump({"signature": signature, "synced_at": datetime.datetime.now().isoformat(timespec="seconds")}, archivo)
+        os.replace(tmp_path, self.path)
+        self.logger.info(f"Feed signature saved to {self.path}")
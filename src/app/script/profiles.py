@@ -0,0 +1,85 @@
+import json
+import os
+
+from pydantic import BaseModel
+
+__all__ = ["SyncProfile", "DEMI", "load_profiles"]
+
+
+class SyncProfile(BaseModel):
+    """
+    Everything that changes from one financiadora's feed to another: where
+    the feed lives, how its columns are named, and how its plans and
+    document types map to core ids. FTP credentials fall back to the
+    FTP_* / BASE_FTP settings.
+    """
+
+    name: str
+    id_financiadora: str
+    ftp_dir: str = "CredencialDigital"
+    feed_file: str = "DEMISALUD-Afiliados.txt"
+    ftp_host: str | None = None
+    ftp_user: str | None = None
+    ftp_password: str | None = None
+    encoding: str = "latin-1"
+    sep: str = "|"
+    # columna del feed -> columna que espera el script (FEED_DTYPES), solo las que difieren
+    columns: dict[str, str] = {}
+    plan_map: dict[str, str]
+    documento_map: dict[str, int]
+
+    def read_csv_kwargs(self) -> dict:
+        """read_csv arguments for this feed, in its own column names."""
+        # schemas trae pandas; los perfiles se cargan antes del preflight
+        from app.script.schemas import FEED_DTYPES
+
+        origen = {destino: columna for columna, destino in self.columns.items()}
+        return {
+            "encoding": self.encoding,
+            "sep": self.sep,
+            "usecols": [origen.get(columna, columna) for columna in FEED_DTYPES],
+            "dtype": {origen.get(columna, columna): dtype for columna, dtype in FEED_DTYPES.items()},
+        }
+
+    def rename(self, df):
+        return df.rename(columns=self.columns) if self.columns else df
+
+
+DEMI = SyncProfile(
+    name="demi",
+    id_financiadora="69633cef-cd44-4ce2-ae8c-3000b61c6849",
+    plan_map={
+        "AZUL PLUS-VOL-ROS": "b60f55eb-c083-416e-a7fa-70657ba4ab81",
+        "AZUL PLUS-OBL-ROS": "b60f55eb-c083-416e-a7fa-70657ba4ab81",
+        "AZUL PLUS- OBLIG-SM": "b60f55eb-c083-416e-a7fa-70657ba4ab81",
+        "AZUL-COSEGURO A CARGO SOCIO 20,00%":"8c86723a-f71a-4eae-8e79-650fe88a6504",
+        "DEMI OP - OBLIG- SM": "a9064b7f-d422-4eac-9eec-e8946f7990aa",
+        "DEMI OP - OBLIG- ROS": "a9064b7f-d422-4eac-9eec-e8946f7990aa",
+        "DEMI OP - VOL- SM": "a9064b7f-d422-4eac-9eec-e8946f7990aa",
+        "DEMI-COSEGURO (SOLO PRACTICAS) 30%\xa0A\xa0CARGO\xa0SOCIO": "e485fb3a-df3f-430a-8389-32cf3f83a783",
+        "VITALICIO": "e0c71154-a805-49e2-bc8b-253be83cf179",
+        "VERDE - OBLIGATORIO": "7aec8bd7-22cf-42e0-84a9-2d0e6637a388",
+        "PLAN BASICO" : "5f322351-b6a9-4976-902a-a05f75779944",
+        "DS 1000": "a1896f07-e202-4c89-be5e-24de5b174014"
+    },
+    documento_map={
+        "DNI": 1,
+        "LE": 7,
+        "LC": 8,
+    },
+)
+
+
+def load_profiles(path: str | None = None) -> dict[str, SyncProfile]:
+    """
+    Registry of sync profiles by name: the built-in DEMI profile plus the
+    ones in the JSON file at `path` (a list of SyncProfile objects), which
+    can also override it.
+    """
+    profiles = {DEMI.name: DEMI}
+    if path and os.path.exists(path):
+        with open(path) as archivo:
+            for perfil in json.load(archivo):
+                profile = SyncProfile(**perfil)
+                profiles[profile.name] = profile
+    return profiles
@@ -0,0 +1,55 @@
+import logging
+import threading
+import time
+
+__all__ = ["Progress"]
+
+
+class Progress:
+    """
+    Aggregated progress of a write loop. Rows and errors are only counted;
+    a line with rows/s, ETA and errors is printed at most once every
+    `interval` seconds, and one row out of every `sample` is logged at
+    DEBUG level.
+    """
+
+    def __init__(self, nombre: str, total: int, interval: float = 10.0, sample: int = 1000):
+        self.nombre = nombre
+        self.total = total
+        self.interval = interval
+        self.sample = max(sample, 1)
+        self.rows = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.inicio = self.ultimo = time.monotonic()
+
+    def advance(self, rows: int = 1, errors: int = 0, detail=None):
+        """
+        Counts `rows` more rows, `errors` of them failed. `detail` is a
+        callable giving the row for the sampled debug log, so it is only
+        formatted when it is actually logged.
+        """
+        with self.lock:
+            antes = self.rows
+            self.rows += rows
+            self.errors += errors
+            muestra = detail is not None and antes // self.sample != self.rows // self.sample
+            ahora = time.monotonic()
+            reportar = ahora - self.ultimo >= self.interval
+            if reportar:
+                self.ultimo = ahora
+        if muestra and self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"{self.nombre} row {self.rows}: {detail()}")
+        if reportar:
+            self.report()
+
+    def report(self):
+        segundos = time.monotonic() - self.inicio
+        ritmo = self.rows / segundos if segundos > 0 else 0.0
+        eta = f"{(self.total - self.rows) / ritmo:.0f}s" if ritmo > 0 else "?"
+        print(f"{self.nombre}: {self.rows}/{self.total} rows, {ritmo:.0f} rows/s, ETA {eta}, {self.errors} errors")
+
+    def finish(self):
+        segundos = time.monotonic() - self.inicio
+        print(f"{self.nombre}: {self.rows} rows in {segundos:.1f}s, {self.errors} errors")
@@ -0,0 +1,102 @@
+import resource
+import sys
+
+import pandas as pd
+
+__all__ = [
+    "FEED_DTYPES",
+    "CORE_DTYPES",
+    "FEED_COMPARE_COLUMNS",
+    "CORE_COMPARE_COLUMNS",
+    "frame_mb",
+    "peak_memory_mb",
+]
+
+# Columnas del feed que usa el script; el resto no se parsea.
+# Las de pocos valores distintos van como category, las claves como Int64
+# y el resto como texto, sin la inferencia int/float que cambia entre archivos.
+FEED_DTYPES = {
+    "NUMEROTARJETA": "Int64",
+    "ID_AFILIADO": "Int64",
+    "ID_TITULAR": "Int64",
+    "APELLIDO_NOMBRE": str,
+    "FECHA_NACIMIENTO": str,
+    "SEXO": "category",
+    "TIPO_DOCUMENTO": "category",
+    "NUMERODOCUMENTO": str,
+    "TELEFONO": str,
+    "NOMBRE_PLAN": "category",
+    "MOROSO": "category",
+    "PROVINCIA": "category",
+    "LOCALIDAD": "category",
+    "CODIGO_POSTAL": str,
+    "CALLE": str,
+    "NUMERO": str,
+    "PISO": str,
+    "DEPARTAMENTO": str,
+}
+
+# Snapshot de core: las columnas con pocos valores distintos
+CORE_DTYPES = {
+    "genero_biologico": "category",
+    "id_financiadora_plan": "category",
+    "estado_actual": "category",
+}
+
+# Lo unico que necesitan compare_rows y los writers de update de cada lado del merge
+FEED_COMPARE_COLUMNS = [
+    "NUMEROTARJETA",
+    "NOMBRE",
+    "APELLIDO",
+    "SEXO",
+    "FECHA_NACIMIENTO",
+    "TIPO_DOCUMENTO",
+    "NUMERODOCUMENTO",
+    "TELEFONO",
+    "NOMBRE_PLAN_NEW",
+    "MOROSO",
+    "CODIGO_POSTAL",
+    "CALLE",
+    "NUMERO",
+    "PISO",
+    "DEPARTAMENTO",
+    "id_loc_localidad",
+    "TITULAR_TARJETA",
+    "id_afi_nuevo",
+    "id_afiliado_titular_nuevo",
+]
+CORE_COMPARE_COLUMNS = [
+    "id_afi",
+    "id_afiliado_plan",
+    "id_afiliado_titular",
+    "id_persona",
+    "codigo",
+    "codigo_titular",
+    "nombre",
+    "apellido",
+    "genero_biologico",
+    "fecha_nacimiento",
+    "id_param_documento_identificatorio",
+    "n_documento",
+    "id_contacto",
+    "telefono",
+    "id_domicilio",
+    "codigo_postal",
+    "calle",
+    "numeracion",
+    "piso",
+    "departamento",
+    "id_financiadora_plan",
+    "estado_actual",
+]
+
+
+def frame_mb(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+
+def peak_memory_mb() -> float:
+    """Peak resident set size of the process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss viene en KB en linux y en bytes en macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
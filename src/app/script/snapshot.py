@@ -0,0 +1,254 @@
+"""
+Core snapshot of one financiadora, read entity by entity. Every query is
+narrow, filtered by financiadora and returns at most one row per key; the
+frame is assembled here with keyed merges. When an afiliado has several
+documents, contacts or addresses the one kept is chosen on purpose (DNI
+first, LLAMADAS contacts first, principal address first) instead of
+whatever row a fanned-out join happened to rank first.
+"""
+import os
+import threading
+
+import pandas as pd
+
+__all__ = ["SNAPSHOT_COLUMNS", "load_snapshot", "read_query", "read_copy", "iter_copy"]
+
+# Columnas (y orden) del frame que devuelve load_old_data
+SNAPSHOT_COLUMNS = [
+    "id_afi",
+    "id_afiliado_plan",
+    "id_afiliado_titular",
+    "id_persona",
+    "codigo",
+    "nombre",
+    "apellido",
+    "genero_biologico",
+    "fecha_nacimiento",
+    "id_param_documento_identificatorio",
+    "n_documento",
+    "id_contacto",
+    "telefono",
+    "id_domicilio",
+    "codigo_postal",
+    "calle",
+    "numeracion",
+    "piso",
+    "departamento",
+    "id_financiadora_plan",
+    "estado_actual",
+]
+
+AFILIADOS = """
+SELECT
+    afiliado.id AS id_afi,
+    afiliado.id_afiliado_titular,
+    persona.id AS id_persona,
+    afiliado.codigo,
+    persona.nombre,
+    persona.apellido,
+    persona.genero_biologico,
+    persona.fecha_nacimiento
+FROM afiliado
+LEFT JOIN persona ON persona.id = afiliado.id_persona
+WHERE afiliado.id_financiadora = %(id_financiadora)s{filtro}
+"""
+
+DOCUMENTOS = """
+SELECT DISTINCT ON (persona_documento.id_persona)
+    persona_documento.id_persona,
+    persona_documento.id_param_documento_identificatorio,
+    persona_documento.valor AS n_documento
+FROM afiliado
+JOIN persona_documento ON persona_documento.id_persona = afiliado.id_persona
+WHERE afiliado.id_financiadora = %(id_financiadora)s{filtro}
+ORDER BY persona_documento.id_persona, persona_documento.id_param_documento_identificatorio, persona_documento.id
+"""
+
+CONTACTOS = """
+SELECT DISTINCT ON (persona_contacto.id_persona)
+    persona_contacto.id_persona,
+    contacto.id AS id_contacto,
+    contacto.valor AS telefono
+FROM afiliado
+JOIN persona_contacto ON persona_contacto.id_persona = afiliado.id_persona
+JOIN contacto ON contacto.id = persona_contacto.id_contacto
+WHERE afiliado.id_financiadora = %(id_financiadora)s{filtro}
+ORDER BY persona_contacto.id_persona, contacto.tipo::text LIKE '%%LLAMADAS%%' DESC, contacto.id
+"""
+
+DOMICILIOS = """
+SELECT DISTINCT ON (persona_domicilio.id_persona)
+    persona_domicilio.id_persona,
+    domicilio.id AS id_domicilio,
+    domicilio.codigo_postal,
+    domicilio.calle,
+    domicilio.numeracion,
+    domicilio.piso,
+    domicilio.departamento
+FROM afiliado
+JOIN persona_domicilio ON persona_domicilio.id_persona = afiliado.id_persona
+JOIN domicilio ON domicilio.id = persona_domicilio.id_domicilio
+WHERE afiliado.id_financiadora = %(id_financiadora)s{filtro}
+ORDER BY persona_domicilio.id_persona, persona_domicilio.es_principal DESC NULLS LAST, domicilio.id
+"""
+
+# Ultimo plan de cada afiliado y ultimo estado de cada plan, como los ROW_NUMBER de antes
+PLANES = """
+SELECT DISTINCT ON (afiliado_plan.id_afiliado)
+    afiliado_plan.id_afiliado AS id_afi,
+    afiliado_plan.id AS id_afiliado_plan,
+    financiadora_plan.id AS id_financiadora_plan
+FROM afiliado
+JOIN afiliado_plan ON afiliado_plan.id_afiliado = afiliado.id
+LEFT JOIN financiadora_plan ON financiadora_plan.id = afiliado_plan.id_financiadora_plan
+WHERE afiliado.id_financiadora = %(id_financiadora)s{filtro}
+ORDER BY afiliado_plan.id_afiliado, afiliado_plan.created_at DESC NULLS LAST, afiliado_plan.id
+"""
+
+ESTADOS = """
+SELECT DISTINCT ON (afiliado_plan_estado.id_afiliado_plan)
+    afiliado_plan_estado.id_afiliado_plan,
+    afiliado_plan_estado.estado AS estado_actual
+FROM afiliado
+JOIN afiliado_plan ON afiliado_plan.id_afiliado = afiliado.id
+JOIN afiliado_plan_estado ON afiliado_plan_estado.id_afiliado_plan = afiliado_plan.id
+WHERE afiliado.id_financiadora = %(id_financiadora)s{filtro}
+ORDER BY afiliado_plan_estado.id_afiliado_plan, afiliado_plan_estado.fecha_desde DESC, afiliado_plan_estado.id
+"""
+
+# Con PLAN_STATE el plan y el estado salen de afiliado_plan_actual
+PLAN_ACTUAL = """
+SELECT
+    id_afiliado AS id_afi,
+    id_afiliado_plan,
+    id_financiadora_plan,
+    estado AS estado_actual
+FROM afiliado_plan_actual
+WHERE id_financiadora = %(id_financiadora)s{filtro_actual}
+"""
+
+
+# Con ids el snapshot se limita a esos afiliados (refresh parcial de SnapshotCache)
+FILTRO_IDS = "\n  AND afiliado.id = ANY(%(ids)s::uuid[])"
+FILTRO_IDS_ACTUAL = "\n  AND id_afiliado = ANY(%(ids)s::uuid[])"
+
+# Columnas que no son texto en el CSV del COPY; el resto queda como str
+NUMERIC_COLUMNS = ["id_param_documento_identificatorio"]
+DATE_COLUMNS = ["fecha_nacimiento"]
+
+
+def read_query(connection, query: str, params: dict) -> pd.DataFrame:
+    return pd.read_sql(query, con=connection, params=params)
+
+
+def typed(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Gives a COPY chunk the types read_sql would have produced."""
+    for columna in chunk.columns.intersection(NUMERIC_COLUMNS):
+        chunk[columna] = pd.to_numeric(chunk[columna])
+    for columna in chunk.columns.intersection(DATE_COLUMNS):
+        # COPY escribe las fechas con el DateStyle ISO por defecto
+        fechas = pd.to_datetime(chunk[columna], format="%Y-%m-%d")
+        chunk[columna] = pd.Series(fechas.dt.date, index=chunk.index, dtype=object).where(fechas.notna(), None)
+    texto = chunk.columns.difference(NUMERIC_COLUMNS + DATE_COLUMNS)
+    chunk[texto] = chunk[texto].astype(object).where(chunk[texto].notna(), None)
+    return chunk
+
+
+def iter_copy(connection, query: str, params: dict, chunksize: int | None = None):
+    """
+    Streams the result of query through COPY ... TO STDOUT into the csv
+    parser, without building a Python tuple per row. Yields typed frames of
+    `chunksize` rows, or a single frame. The COPY runs in a helper thread
+    writing into a pipe, so only the chunk being parsed is in memory. A
+    COPY that fails midway is raised after the last frame: the frames only
+    hold the whole result once the generator is exhausted.
+    """
+    cursor = connection.cursor()
+    sql = cursor.mogrify(query, params).decode("utf-8")
+    lector, escritor = os.pipe()
+    errores = []
+
+    def producir():
+        try:
+            with os.fdopen(escritor, "wb") as salida:
+                cursor.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '\\N')", salida)
+        except Exception as e:
+            errores.append(e)
+
+    hilo = threading.Thread(target=producir, name="snapshot-copy")
+    hilo.start()
+    try:
+        with os.fdopen(lector, "rb") as entrada:
+            # solo \N es NULL: "" y textos como "NA" quedan como texto, igual que en read_sql
+            frames = pd.read_csv(
+                entrada,
+                dtype=str,
+                keep_default_na=False,
+                na_values=["\\N"],
+                encoding="utf-8",
+                chunksize=chunksize,
+            )
+            for chunk in ([frames] if chunksize is None else frames):
+                yield typed(chunk)
+    except Exception:
+        # si el COPY fallo, el error del parser (p.ej. sin header) es solo una consecuencia
+        hilo.join()
+        if errores:
+            raise errores[0]
+        raise
+    finally:
+        hilo.join()
+        cursor.close()
+    if errores:
+        raise errores[0]
+
+
+def read_copy(connection, query: str, params: dict) -> pd.DataFrame:
+    """
+    Whole result of query as one frame. The generator is drained, so an
+    error of the COPY after the csv was parsed is raised instead of
+    returning a truncated snapshot.
+    """
+    (df,) = iter_copy(connection, query, params)
+    return df
+
+
+def load_snapshot(
+    connection,
+    id_financiadora: str,
+    plan_state: bool = False,
+    copy: bool = False,
+    ids: list[str] | None = None,
+) -> pd.DataFrame:
+    """
+    One row per afiliado of the financiadora, with SNAPSHOT_COLUMNS. With
+    ids, only those afiliados.
+    """
+    params = {"id_financiadora": id_financiadora}
+    if ids is not None:
+        params["ids"] = [str(id_afi) for id_afi in ids]
+
+    def leer(query):
+        query = query.format(
+            filtro=FILTRO_IDS if ids is not None else "",
+            filtro_actual=FILTRO_IDS_ACTUAL if ids is not None else "",
+        )
+        if copy:
+            return read_copy(connection, query, params)
+        return read_query(connection, query, params)
+
+    df = leer(AFILIADOS)
+    df = df.merge(leer(DOCUMENTOS), on="id_persona", how="left")
+    df = df.merge(leer(CONTACTOS), on="id_persona", how="left")
+    df = df.merge(leer(DOMICILIOS), on="id_persona", how="left")
+    if plan_state:
+        planes = leer(PLAN_ACTUAL)
+    else:
+        planes = leer(PLANES).merge(leer(ESTADOS), on="id_afiliado_plan", how="left")
+    df = df.merge(planes, on="id_afi", how="left")
+    df["estado_actual"] = df["estado_actual"].fillna("ACTIVO")
+    df = df[SNAPSHOT_COLUMNS]
+    # los merges dejan NaN donde read_sql dejaba None
+    texto = df.select_dtypes(include="object").columns
+    df[texto] = df[texto].astype(object).where(df[texto].notna(), None)
+    return df
@@ -0,0 +1,197 @@
+"""
+Local Parquet copy of the core snapshot of each financiadora, refreshed
+incrementally. Rows carry the id of the transaction that last wrote them
+(xmin); the cache stores the oldest transaction still running when it was
+taken, and the next run only reloads the afiliados with an afiliado,
+persona, documento, contacto, domicilio, plan or estado row written since.
+"""
+import datetime
+import json
+import logging
+import os
+
+import pandas as pd
+
+from app.script.snapshot import SNAPSHOT_COLUMNS
+
+__all__ = ["SnapshotCache"]
+
+# xmin del snapshot actual (64 bits, con epoch) y desde cuantas transacciones VACUUM puede congelar filas
+WATERMARK = """
+SELECT txid_snapshot_xmin(txid_current_snapshot()), current_setting('vacuum_freeze_min_age')::bigint
+"""
+
+# Afiliados con alguna fila escrita desde el watermark, tabla por tabla
+CHANGED = """
+SELECT afiliado.id FROM afiliado
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND afiliado.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM persona
+JOIN afiliado ON afiliado.id_persona = persona.id
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND persona.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM persona_documento
+JOIN afiliado ON afiliado.id_persona = persona_documento.id_persona
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND persona_documento.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM persona_contacto
+JOIN afiliado ON afiliado.id_persona = persona_contacto.id_persona
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND persona_contacto.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM contacto
+JOIN persona_contacto ON persona_contacto.id_contacto = contacto.id
+JOIN afiliado ON afiliado.id_persona = persona_contacto.id_persona
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND contacto.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM persona_domicilio
+JOIN afiliado ON afiliado.id_persona = persona_domicilio.id_persona
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND persona_domicilio.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM domicilio
+JOIN persona_domicilio ON persona_domicilio.id_domicilio = domicilio.id
+JOIN afiliado ON afiliado.id_persona = persona_domicilio.id_persona
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND domicilio.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM afiliado_plan
+JOIN afiliado ON afiliado.id = afiliado_plan.id_afiliado
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND afiliado_plan.xmin::text::bigint >= %(xmin)s
+UNION
+SELECT afiliado.id FROM afiliado_plan_estado
+JOIN afiliado_plan ON afiliado_plan.id = afiliado_plan_estado.id_afiliado_plan
+JOIN afiliado ON afiliado.id = afiliado_plan.id_afiliado
+WHERE afiliado.id_financiadora = %(id_financiadora)s AND afiliado_plan_estado.xmin::text::bigint >= %(xmin)s
+"""
+
+CHANGED_PLAN_ACTUAL = """
+UNION
+SELECT id_afiliado FROM afiliado_plan_actual
+WHERE id_financiadora = %(id_financiadora)s AND xmin::text::bigint >= %(xmin)s
+"""
+
+AFILIADO_COUNT = """
+SELECT count(*) FROM afiliado WHERE id_financiadora = %(id_financiadora)s
+"""
+
+AFILIADO_IDS = """
+SELECT id FROM afiliado WHERE id_financiadora = %(id_financiadora)s
+"""
+
+# Si cambio mas de esta fraccion del cache, recargar todo es mas barato que filtrar por ids
+FULL_RELOAD_FRACTION = 0.5
+
+
+class SnapshotCache:
+    """
+    One `<id_financiadora>.parquet` plus its `.json` watermark per
+    financiadora under `path`. `max_age_hours` forces a full reload every so
+    often, which also picks up deleted documentos/contactos/domicilios that
+    xmin cannot see.
+    """
+
+    def __init__(self, path: str, max_age_hours: float = 24):
+        self.path = path
+        self.max_age_hours = max_age_hours
+        self.logger = logging.getLogger(__name__)
+
+    def files(self, id_financiadora: str) -> tuple[str, str]:
+        base = os.path.join(self.path, id_financiadora)
+        return f"{base}.parquet", f"{base}.json"
+
+    def read_meta(self, id_financiadora: str) -> dict | None:
+        datos, meta = self.files(id_financiadora)
+        if not (os.path.exists(datos) and os.path.exists(meta)):
+            return None
+        with open(meta) as archivo:
+            return json.load(archivo)
+
+    def usable(self, meta: dict | None, watermark: int, freeze_min_age: int, plan_state: bool) -> str | None:
+        """None if the stored watermark can drive an incremental refresh, else why not."""
+        if meta is None:
+            return "no cached snapshot"
+        if meta.get("plan_state") != plan_state:
+            return "cached with another plan_state"
+        edad = datetime.datetime.now() - datetime.datetime.fromisoformat(meta["full_at"])
+        if edad > datetime.timedelta(hours=self.max_age_hours):
+            return f"last full load is {edad} old"
+        anterior = meta["watermark"]
+        # xmin es de 32 bits: solo se compara dentro del mismo epoch
+        if anterior >> 32 != watermark >> 32:
+            return "transaction id wraparound since the last run"
+        if watermark < anterior:
+            return "watermark is ahead of the database (restored or another server?)"
+        # VACUUM FREEZE pudo haber pisado el xmin de filas escritas despues del watermark
+        if watermark - anterior >= freeze_min_age:
+            return "watermark older than vacuum_freeze_min_age"
+        return None
+
+    def refresh(self, connection, id_financiadora: str, loader, plan_state: bool = False) -> pd.DataFrame:
+        """
+        Snapshot of the financiadora: the cached one with the afiliados
+        changed since its watermark reloaded through `loader(ids)`, or a
+        full `loader(None)` when the watermark is unusable. The result is
+        written back with the new watermark.
+        """
+        cursor = connection.cursor()
+        try:
+            # el watermark se toma antes de leer: lo que se escriba mientras tanto se relee la proxima vez
+            cursor.execute(WATERMARK)
+            watermark, freeze_min_age = cursor.fetchone()
+            meta = self.read_meta(id_financiadora)
+            motivo = self.usable(meta, watermark, freeze_min_age, plan_state)
+            cached = None
+            if motivo is None:
+                try:
+                    cached = pd.read_parquet(self.files(id_financiadora)[0])
+                except Exception as e:
+                    motivo = f"cached snapshot unreadable ({e})"
+            if cached is not None and list(cached.columns) != SNAPSHOT_COLUMNS:
+                # escrito por una version con otras columnas
+                motivo = "cached with other snapshot columns"
+                cached = None
+            if cached is not None:
+                params = {"id_financiadora": id_financiadora, "xmin": meta["watermark"] & 0xFFFFFFFF}
+                cursor.execute(CHANGED + (CHANGED_PLAN_ACTUAL if plan_state else ""), params)
+                ids = [str(fila[0]) for fila in cursor.fetchall()]
+                if len(ids) > FULL_RELOAD_FRACTION * len(cached):
+                    motivo = f"{len(ids)} of {len(cached)} afiliados changed"
+                    cached = None
+            if cached is None:
+                self.logger.info(f"Full core snapshot of {id_financiadora}: {motivo}")
+                df = loader(None)
+                full_at = datetime.datetime.now()
+            else:
+                df = cached[~cached["id_afi"].isin(ids)]
+                if ids:
+                    df = pd.concat([df, loader(ids)], ignore_index=True)
+                # los afiliados borrados de core no aparecen por xmin: se comparan los conteos
+                cursor.execute(AFILIADO_COUNT, {"id_financiadora": id_financiadora})
+                if cursor.fetchone()[0] != len(df):
+                    cursor.execute(AFILIADO_IDS, {"id_financiadora": id_financiadora})
+                    vigentes = {str(fila[0]) for fila in cursor.fetchall()}
+                    df = df[df["id_afi"].isin(vigentes)]
+                df = df.reset_index(drop=True)
+                self.logger.info(f"Core snapshot of {id_financiadora} from cache, {len(ids)} afiliados reloaded")
+                full_at = datetime.datetime.fromisoformat(meta["full_at"])
+        finally:
+            cursor.close()
+        self.write(id_financiadora, df, watermark, full_at, plan_state)
+        return df
+
+    def write(self, id_financiadora: str, df: pd.DataFrame, watermark: int, full_at: datetime.datetime, plan_state: bool):
+        datos, meta = self.files(id_financiadora)
+        os.makedirs(self.path, exist_ok=True)
+        # primero los datos y despues el watermark, cada uno reemplazado de una vez
+        df.to_parquet(f"{datos}.tmp", index=False)
+        os.replace(f"{datos}.tmp", datos)
+        with open(f"{meta}.tmp", "w") as archivo:
+            json.dump(
+                {
+                    "watermark": watermark,
+                    "full_at": full_at.isoformat(timespec="seconds"),
+                    "written_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "plan_state": plan_state,
+                    "rows": len(df),
+                },
+                archivo,
+            )
+        os.replace(f"{meta}.tmp", meta)
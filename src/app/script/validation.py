@@ -0,0 +1,56 @@
+"""
+Row checks run on the standarize_data output, before anything is written.
+Every rule is a vectorized mask over the whole frame; rows failing any of
+them are written with their reasons to a quarantine CSV and kept out of the
+writers, so one malformed line does not roll back a whole transaction.
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["RULES", "rejection_reasons", "Quarantine"]
+
+# standarize_data deja "" (o NaT) donde el mapeo o la resolucion no encontro
+# nada; cada uno termina en un insert o una FK que falla
+RULES = {
+    "unmapped_plan": lambda df: df["NOMBRE_PLAN_NEW"] == "",
+    # to_datetime(errors="coerce") deja NaT, que fillna("") no toca en una columna datetime
+    "invalid_fecha_nacimiento": lambda df: df["FECHA_NACIMIENTO"].isna() | (df["FECHA_NACIMIENTO"] == ""),
+    "unresolved_localidad": lambda df: df["id_loc_localidad"] == "",
+    "unmapped_tipo_documento": lambda df: df["TIPO_DOCUMENTO"] == "",
+}
+
+
+def rejection_reasons(df: pd.DataFrame) -> pd.Series:
+    """Comma-separated names of the rules each row fails, "" for clean rows."""
+    motivos = np.full(len(df), "", dtype=object)
+    for nombre, regla in RULES.items():
+        falla = regla(df).to_numpy(dtype=bool)
+        motivos[falla] = np.where(motivos[falla] == "", nombre, motivos[falla] + "," + nombre)
+    return pd.Series(motivos, index=df.index)
+
+
+class Quarantine:
+    """
+    CSV of the rejected feed rows of the current run: the raw row plus a
+    `motivos` column, appended chunk by chunk in stream mode.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rows = 0
+        self.logger = logging.getLogger(__name__)
+        # el archivo es de la ultima corrida: una corrida sin rechazos no deja uno viejo
+        if os.path.exists(path):
+            os.remove(path)
+
+    def write(self, raw: pd.DataFrame, motivos: pd.Series):
+        if len(raw) == 0:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        primera = self.rows == 0
+        raw.assign(motivos=motivos.to_numpy()).to_csv(self.path, mode="w" if primera else "a", header=primera, index=False)
+        self.rows += len(raw)
+        self.logger.warning(f"{len(raw)} feed rows quarantined to {self.path}")
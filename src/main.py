@@ -1,18 +1,237 @@
+import argparse
 import logging
-from app.script.demi import ScriptDemi
-from app.core.database import connect
+import os
+from concurrent.futures import ThreadPoolExecutor
+# solo lo liviano: pandas, numpy y psycopg2 se importan despues del preflight
+from app.script.preflight import FeedState, feed_signature
+from app.script.profiles import SyncProfile, load_profiles
 from app.core import settings
 
+
+def profile_path(path: str, profile: SyncProfile) -> str:
+    """metrics.json -> metrics-<profile>.json, so every profile writes its own file."""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{profile.name}{ext}"
+
+
+def feed_state(profile: SyncProfile) -> FeedState:
+    return FeedState(os.path.join(settings.STATE_DIR, profile.name, "feed.json"))
+
+
+def changed_profiles(profiles: list[SyncProfile]) -> dict[str, str | None]:
+    """
+    Pre-flight: signature of the feed of every profile whose feed changed
+    since its last successful sync. Profiles whose signature cannot be read
+    are kept (with None), so an FTP hiccup never skips a sync.
+    """
+    cambiados = {}
+    for profile in profiles:
+        try:
+            firma = feed_signature(profile, ftp=True, timeout=settings.NEW_DATA_TIMEOUT)
+        except Exception:
+            logging.warning(f"Pre-flight of {profile.name} failed, syncing anyway", exc_info=True)
+            cambiados[profile.name] = None
+            continue
+        if firma == feed_state(profile).last():
+            print(f"[{profile.name}] Feed unchanged since the last sync, skipping")
+            continue
+        cambiados[profile.name] = firma
+    return cambiados
+
+
+def run_profile(profile: SyncProfile, args: argparse.Namespace, pool, gazetteer, signature: str | None = None) -> bool:
+    """
+    Runs one financiadora end to end on its own pooled connection, with its
+    own state directory, checkpoint and metrics. Errors and failed writes
+    are logged and reported as False so the other profiles keep running.
+    """
+    import datetime
+    from app.script.changeset import Changeset
+    from app.script.checkpoint import CheckpointJournal
+    from app.script.demi import BUENOS_AIRES_TZ, ScriptDemi
+    from app.script.fingerprints import FingerprintStore
+    from app.script.metrics import Metrics
+    from app.script.plan_state import backfill
+    from app.script.schemas import peak_memory_mb
+    from app.script.snapshot_cache import SnapshotCache
+    from app.script.validation import Quarantine
+
+    state_dir = os.path.join(settings.STATE_DIR, profile.name)
+    changeset_path = args.changeset or os.path.join(state_dir, "changeset")
+    metrics = Metrics() if settings.METRICS else None
+    if metrics is not None:
+        metrics.extra["success"] = 0
+    script = None
+    conn = pool.getconn()
+    # desde aca la conexion vuelve al pool pase lo que pase, tambien si falla armar el script
+    try:
+        fingerprints = None
+        if settings.INCREMENTAL:
+            fingerprints = FingerprintStore(os.path.join(state_dir, "fingerprints.npz"))
+        snapshot_cache = None
+        if settings.SNAPSHOT_CACHE:
+            # un archivo por financiadora, compartido por los perfiles que la sincronizan
+            snapshot_cache = SnapshotCache(os.path.join(settings.STATE_DIR, "snapshots"), settings.SNAPSHOT_CACHE_MAX_AGE)
+        checkpoint = None
+        if settings.BATCH_COMMIT and args.mode == "sync":
+            # una corrida interrumpida solo se reanuda sobre el mismo feed
+            if signature is None:
+                try:
+                    signature = feed_signature(profile, ftp=True, timeout=settings.NEW_DATA_TIMEOUT)
+                except Exception:
+                    logging.warning(f"Could not read the feed signature of {profile.name}, keying the checkpoint by date", exc_info=True)
+            checkpoint = CheckpointJournal(
+                os.path.join(state_dir, "checkpoint.jsonl"),
+                run_key=signature or f"date:{datetime.datetime.now(BUENOS_AIRES_TZ).date()}",
+                identifies_feed=signature is not None,
+            )
+        script = ScriptDemi(
+            connection=conn,
+            verbose=settings.VERBOSE,
+            ftp=True,
+            bulk=settings.BULK_INSERT,
+            bulk_update=settings.BULK_UPDATE,
+            batch_size=settings.BATCH_SIZE,
+            stream=settings.STREAM,
+            stream_memory_mb=settings.STREAM_MEMORY_MB,
+            fingerprints=fingerprints,
+            full_reconcile=settings.FULL_RECONCILE,
+            gazetteer=gazetteer,
+            pool=pool if settings.WRITER_WORKERS > 1 else None,
+            workers=settings.WRITER_WORKERS,
+            checkpoint=checkpoint,
+            metrics=metrics,
+            changeset=Changeset(changeset_path) if args.mode == "plan" else None,
+            progress_interval=settings.PROGRESS_INTERVAL,
+            progress_sample=settings.PROGRESS_SAMPLE,
+            profile=profile,
+            old_data_timeout=settings.OLD_DATA_TIMEOUT,
+            new_data_timeout=settings.NEW_DATA_TIMEOUT,
+            plan_state=settings.PLAN_STATE,
+            snapshot_copy=settings.SNAPSHOT_COPY,
+            snapshot_cache=snapshot_cache,
+            deactivate_missing=settings.DEACTIVATE_MISSING,
+            missing_max_fraction=settings.MISSING_MAX_FRACTION,
+            feed_parser=settings.FEED_PARSER,
+            # apply y backfill no validan: no deben pisar el reporte del plan
+            quarantine=Quarantine(os.path.join(state_dir, "quarantine.csv")) if settings.VALIDATE and args.mode in ("sync", "plan") else None,
+        )
+        #1: buscar los afifos en core
+        #2: buscar los afifos en CSS
+        #3: los afifos que estan en css pero no en core, cargar a core con todos sus datos
+        #4: los afifos que estan en ambas separarlos en los que tienen diferencias (la info de un afifo en core puede estar desactualizada)
+        #5: los afifos que tienen data vieja en core hay que actualizarlos con la data nueva de CSS
+        ok = True
+        if args.mode == "backfill-plan-state":
+            filas = backfill(script.connection, profile.id_financiadora)
+            print(f"[{profile.name}] afiliado_plan_actual backfilled: {filas} afiliados")
+        elif args.mode == "apply":
+            changeset = Changeset.load(changeset_path)
+            print(f"[{profile.name}] Applying changeset {changeset_path}: {changeset.manifest['inserts'].get('afiliado', 0)} inserts, {changeset.manifest['updates']} updates")
+            if not script.apply_changeset(changeset):
+                return False
+            # los fingerprints del plan recien valen cuando core tiene sus cambios
+            if os.path.exists(changeset.fingerprints_path):
+                os.makedirs(state_dir, exist_ok=True)
+                os.replace(changeset.fingerprints_path, os.path.join(state_dir, "fingerprints.npz"))
+        else:
+            if script.stream:
+                ok = script.sync_streaming(script.load_old_data())
+            else:
+                # snapshot de core y feed en paralelo
+                old, new = script.load_data()
+                ok = script.compare_data(old, new)
+            if args.mode == "plan":
+                script.changeset.save(fingerprints=fingerprints)
+                print(f"[{profile.name}] Changeset written to {changeset_path}: {script.changeset.manifest['inserts'].get('afiliado', 0)} inserts, {script.changeset.manifest['updates']} updates")
+            elif fingerprints is not None:
+                fingerprints.save()
+        # un writer que fallo deshace su transaccion y sus filas quedan en fallidos
+        ok = ok and not script.fallidos
+        # la firma da el feed por sincronizado: con filas fallidas no se guarda y la proxima
+        # corrida las reintenta aunque el feed no cambie. Las de cuarentena no cuentan: con
+        # el mismo feed se rechazarian igual, quedan en el reporte hasta que el feed cambie
+        if args.mode == "sync" and signature is not None and ok:
+            feed_state(profile).save(signature)
+        if metrics is not None and ok:
+            metrics.extra["success"] = 1
+    except Exception:
+        logging.error(f"Sync of {profile.name} failed", exc_info=True)
+        return False
+    finally:
+        pool.putconn(conn)
+        if metrics is not None:
+            # se escriben tambien si la corrida falla, para ver donde se corto
+            metrics.extra["peak_memory_bytes"] = round(peak_memory_mb() * 1024 * 1024)
+            if script is not None:
+                metrics.extra["failed_rows"] = len(script.fallidos)
+                metrics.extra["quarantined_rows"] = len(script.rechazados)
+            metrics.write_json(profile_path(settings.METRICS_JSON, profile))
+            metrics.write_prometheus(profile_path(settings.METRICS_TEXTFILE, profile), labels={"financiadora": profile.name})
+    if script.rechazados:
+        print(f"[{profile.name}] Afis quarantined: {len(script.rechazados)} (see {script.quarantine.path})")
+    if checkpoint is not None:
+        if script.fallidos:
+            print(f"[{profile.name}] Afis that could not be written: {len(script.fallidos)}")
+        else:
+            checkpoint.clear()
+    if not ok:
+        logging.error(f"Sync of {profile.name} finished with failed writes")
+    return ok
+
+
 if __name__ == "__main__":
-    conn = connect()
+    parser = argparse.ArgumentParser(description="Sync financiadora afiliados into core.")
+    parser.add_argument(
+        "mode",
+        nargs="?",
+        choices=["sync", "plan", "apply", "backfill-plan-state"],
+        default="sync",
+        help=(
+            "sync writes directly; plan only writes a changeset; apply writes a planned changeset; "
+            "backfill-plan-state (re)builds afiliado_plan_actual"
+        ),
+    )
+    parser.add_argument("--profile", nargs="+", default=settings.PROFILES.split(","), help="sync profiles to run")
+    parser.add_argument("--changeset", help="changeset directory (default: <STATE_DIR>/<profile>/changeset)")
+    parser.add_argument("--force", action="store_true", help="sync even if the pre-flight finds the feed unchanged")
+    args = parser.parse_args()
+
+    registry = load_profiles(settings.PROFILES_FILE)
+    unknown = [name for name in args.profile if name not in registry]
+    if unknown:
+        parser.error(f"unknown profiles: {', '.join(unknown)}")
+    if args.changeset and len(args.profile) > 1:
+        parser.error("--changeset needs a single --profile")
+    profiles = [registry[name] for name in args.profile]
+
     verbose=settings.VERBOSE
     logging.basicConfig(level=logging.DEBUG if verbose else logging.WARNING)
-    script = ScriptDemi(connection=conn, verbose=verbose, ftp=True)
-    #1: buscar los afifos en core
-    #2: buscar los afifos en CSS
-    #3: los afifos que estan en css pero no en core, cargar a core con todos sus datos
-    #4: los afifos que estan en ambas separarlos en los que tienen diferencias (la info de un afifo en core puede estar desactualizada)
-    #5: los afifos que tienen data vieja en core hay que actualizarlos con la data nueva de CSS
-    old = script.load_old_data()
-    new = script.load_new_data()
-    script.compare_data(old, new)
+    signatures = {}
+    if settings.PREFLIGHT and args.mode == "sync" and not args.force:
+        signatures = changed_profiles(profiles)
+        profiles = [profile for profile in profiles if profile.name in signatures]
+        if not profiles:
+            raise SystemExit(0)
+
+    from app.core.database import connect, create_pool
+    from app.script.gazetteer import Gazetteer
+    from app.script.schemas import peak_memory_mb
+    # una conexion por perfil mas las de sus writers; el cache geografico es uno solo
+    pool = create_pool(len(profiles) * (1 + max(settings.WRITER_WORKERS, 1)))
+    conn = connect()
+    gazetteer = Gazetteer(conn, os.path.join(settings.STATE_DIR, "gazetteer.pkl"))
+    try:
+        with ThreadPoolExecutor(max_workers=len(profiles)) as executor:
+            results = dict(zip(
+                (profile.name for profile in profiles),
+                executor.map(lambda profile: run_profile(profile, args, pool, gazetteer, signatures.get(profile.name)), profiles),
+            ))
+    finally:
+        print(f"Peak memory: {peak_memory_mb():.0f} MB")
+        pool.closeall()
+        conn.close()
+    failed = [name for name, ok in results.items() if not ok]
+    if failed:
+        print(f"Profiles that failed: {', '.join(failed)}")
+        raise SystemExit(1)